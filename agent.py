@@ -1,10 +1,14 @@
 #! /usr/bin/env python3
 import copy
 
-from utils.utils import OUNoise, empty_torch_queue, test_goals
+from utils.utils import OUNoise, empty_torch_queue, test_goals, stack_transitions, flatten_obs, agent_n_step, \
+    uses_her
+from utils.shared_memory import SharedReplayStorage
+from utils.running_stats import obs_rms_path
 from collections import deque
 import butia_gym
 import numpy as np
+import queue
 import torch
 import time
 import gym
@@ -12,7 +16,8 @@ import os
 
 
 class Agent(object):
-    def __init__(self, config, policy, global_episode, global_step, n_agent=0, agent_type='exploration', log_dir=''):
+    def __init__(self, config, policy, global_episode, global_step, n_agent=0, agent_type='exploration', log_dir='',
+                 ratio_controller=None, obs_stats=None):
         print(f"Initializing agent {n_agent}...")
         self.config = config
         self.action_low = -1.0
@@ -25,14 +30,25 @@ class Agent(object):
         self.global_step = global_step
         self.local_episode = 0
         self.log_dir = log_dir
-        # number of future steps to collect experiences for N-step returns
-        self.n_step_returns = config['n_step_return']
+        # number of future steps to collect experiences for N-step returns, 1 when the replay buffer builds them
+        # at sample time or relabels the transitions with HER
+        self.n_step_returns = agent_n_step(config)
         self.discount_rate = config['discount_rate']  # Discount rate (gamma) for future rewards
         # agent gets latest parameters from learner every update_agent_ep episodes
         self.update_agent_ep = config['update_agent_ep']
+        # exploration agents wait for the learner when it falls behind the target replay ratio
+        self.ratio_controller = ratio_controller if agent_type == 'exploration' else None
+        # running state statistics published by the sampler, the networks see normalized states when given
+        self.obs_stats = obs_stats
 
         # Initialise deque buffer to store experiences for N-step returns
         self.exp_buffer = deque()
+        # N-step transitions not sent yet, they go to the sampler in one message per episode (or per chunk of
+        # replay_chunk_size transitions when the replay buffer does not need whole episodes)
+        self.episode_transitions = []
+        whole_episodes = uses_her(config) or config['replay_memory_dedup'] or config['replay_sample_n_step']
+        self.chunk_size = 0 if whole_episodes else config['replay_chunk_size']
+        self.training_on = None
 
         # Create environment
         self.ou_noise = OUNoise(dim=config['action_dim'], low=self.action_low, high=self.action_high)
@@ -41,21 +57,37 @@ class Agent(object):
         self.actor = policy
         print("Started agent", n_agent, "using", config['device'])
 
-    def update_actor_learner(self, learner_w_queue, training_on):
-        """Update local actor to the actor from learner. """
+    def update_actor_learner(self, policy_weights, training_on):
+        """Update local actor to the latest actor published by the learner. """
         if not training_on.value:
             return
-        try:
-            source = learner_w_queue.get_nowait()
-        except:
+        policy_weights.load_into(self.actor)
+
+    def store_transition(self, replay_queue, transition):
+        """Queue a transition for the sampler, or write it in place when the replay lives in shared memory."""
+        if isinstance(replay_queue, SharedReplayStorage):
+            replay_queue.write(*transition)
             return
-        target = self.actor
-        for target_param, source_param in zip(target.parameters(), source):
-            w = torch.tensor(source_param).float()
-            target_param.data.copy_(w)
-        del source
+        self.episode_transitions.append(transition)
+        if self.chunk_size and len(self.episode_transitions) >= self.chunk_size:
+            self.flush_episode(replay_queue)
 
-    def run(self, training_on, replay_queue, learner_w_queue, logs):
+    def flush_episode(self, replay_queue):
+        """Send the pending transitions to the sampler as a single contiguous message."""
+        if len(self.episode_transitions) == 0:
+            return
+        message = stack_transitions(self.episode_transitions)
+        self.episode_transitions = []
+        # wait for room in the queue instead of dropping data, unless training is over
+        while self.training_on is None or self.training_on.value:
+            try:
+                replay_queue.put(message, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def run(self, training_on, replay_queue, policy_weights, logs):
+        self.training_on = training_on
         env = gym.make('DoRISPickAndPlace-v1')
         time.sleep(1)
 
@@ -81,6 +113,11 @@ class Agent(object):
                 state_net = copy.deepcopy(state)
                 if self.config['her_memory']:
                     state_net = np.concatenate([v for v in state_net.values()])
+                if self.obs_stats is not None:
+                    state_net = self.obs_stats.get().normalize(flatten_obs(state_net))
+                if self.agent_type == "exploitation" and policy_weights is not None:
+                    # latest complete target policy snapshot, a version compare when nothing changed
+                    policy_weights.load_into(self.actor)
 
                 if self.n_agent == 0:
                     env.render()
@@ -97,6 +134,8 @@ class Agent(object):
                 # action[0] = np.clip(action[0], self.action_low[0], self.action_high[0])
                 # action[1] = np.clip(action[1], self.action_low[1], self.action_high[1])
 
+                if self.ratio_controller is not None:
+                    self.ratio_controller.wait_agent(training_on)
                 next_state, reward, done, info = env.step(action)
                 episode_reward += reward
 
@@ -105,7 +144,7 @@ class Agent(object):
 
                     # We need at least N steps in the experience buffer before we can compute Bellman
                     # rewards and add an N-step experience to replay memory
-                    if len(self.exp_buffer) >= self.config['n_step_return']:
+                    if len(self.exp_buffer) >= self.n_step_returns:
                         state_0, action_0, reward_0 = self.exp_buffer.popleft()
                         discounted_reward = reward_0
                         gamma = self.config['discount_rate']
@@ -114,10 +153,7 @@ class Agent(object):
                             gamma *= self.config['discount_rate']
                         # We want to fill buffer only with form explorator
                         if self.agent_type == "exploration":
-                            try:
-                                replay_queue.put_nowait([state_0, action_0, discounted_reward, next_state, done, gamma])
-                            except:
-                                pass
+                            self.store_transition(replay_queue, [state_0, action_0, discounted_reward, next_state, done, gamma])
 
                 state = next_state
                 # if self.config['her_memory']:
@@ -134,11 +170,9 @@ class Agent(object):
                                 discounted_reward += r_i * gamma
                                 gamma *= self.config['discount_rate']
                             if self.agent_type == "exploration":
-                                try:
-                                    replay_queue.put_nowait([state_0, action_0, discounted_reward, next_state, done,
-                                                             gamma])
-                                except:
-                                    pass
+                                self.store_transition(replay_queue, [state_0, action_0, discounted_reward,
+                                                                     next_state, done, gamma])
+                        self.flush_episode(replay_queue)
                     break
 
                 num_steps += 1
@@ -180,9 +214,9 @@ class Agent(object):
 
                 rewards.append(episode_reward)
                 if self.agent_type == "exploration" and self.local_episode % self.config['update_agent_ep'] == 0:
-                    self.update_actor_learner(learner_w_queue, training_on)
+                    self.update_actor_learner(policy_weights, training_on)
 
-        if not self.config['test']:
+        if not self.config['test'] and not isinstance(replay_queue, SharedReplayStorage):
             empty_torch_queue(replay_queue)
         print(f"Agent {self.n_agent} done.")
 
@@ -192,3 +226,6 @@ class Agent(object):
             os.makedirs(process_dir)
         model_fn = f"{process_dir}/{checkpoint_name}.pt"
         torch.save(self.actor.state_dict(), model_fn)
+        if self.obs_stats is not None:
+            # the policy only makes sense on states normalized the same way
+            self.obs_stats.get().save(obs_rms_path(model_fn))
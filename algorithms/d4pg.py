@@ -1,5 +1,6 @@
-from utils.l2_projection import _l2_project
-from utils.utils import empty_torch_queue
+from utils.l2_projection import l2_project
+from utils.utils import empty_torch_queue, flatten_obs, split_super_batch, to_tensor, to_numpy, PriorityUpdateBatcher, \
+    TargetUpdater, MixedPrecision
 from models import ValueNetwork
 import torch.optim as optim
 import torch.nn as nn
@@ -11,7 +12,7 @@ import time
 
 class LearnerD4PG(object):
     """Policy and value network update routine. """
-    def __init__(self, config, policy_net, target_policy_net, learner_w_queue, log_dir=''):
+    def __init__(self, config, policy_net, target_policy_net, policy_weights, log_dir='', obs_stats=None, target_weights=None):
         self.config = config
         value_lr = config['critic_learning_rate']
         policy_lr = config['actor_learning_rate']
@@ -27,7 +28,11 @@ class LearnerD4PG(object):
         self.gamma = config['discount_rate']  # Discount rate (gamma) for future rewards
         self.log_dir = log_dir
         self.prioritized_replay = config['replay_memory_prioritized']
-        self.learner_w_queue = learner_w_queue
+        self.policy_weights = policy_weights  # SharedPolicyWeights read by the exploration agents
+        # SharedPolicyWeights of the target policy the exploitation agent acts with
+        self.target_weights = target_weights
+        # running state statistics published by the sampler, states are normalized with them when given
+        self.obs_stats = obs_stats
         self.delta_z = (self.v_max - self.v_min) / (self.num_atoms - 1)
 
         # Value and policy nets
@@ -38,58 +43,60 @@ class LearnerD4PG(object):
                                              self.v_min, self.v_max, self.num_atoms, device=self.device)
         self.target_policy_net = target_policy_net
 
-        for target_param, param in zip(self.target_value_net.parameters(), self.value_net.parameters()):
-            target_param.data.copy_(param.data)
-
-        for target_param, param in zip(self.target_policy_net.parameters(), self.policy_net.parameters()):
-            target_param.data.copy_(param.data)
+        self.target_updater = TargetUpdater((self.value_net, self.target_value_net),
+                                            (self.policy_net, self.target_policy_net))
+        self.target_updater.hard_update()
 
         self.value_optimizer = optim.Adam(self.value_net.parameters(), lr=value_lr)
         self.policy_optimizer = optim.Adam(self.policy_net.parameters(), lr=policy_lr)
 
         self.value_criterion = nn.BCELoss(reduction='none')
+        self.precision = MixedPrecision(config['learner_precision'], self.device)
+        self.precision_log = 8 + 3 * config['num_agents']  # entry of the skipped updates in the shared logs
 
     def _update_step(self, batch, replay_priority_queue, update_step, logs):
         update_time = time.time()
+        self.precision.begin_update()
 
         state, action, reward, next_state, done, gamma, weights, inds = batch
-        state = list(state.values())
-        next_state = list(next_state.values())
-
-        state = np.asarray(state)
-        action = np.asarray(action)
-        reward = np.asarray(reward)
-        next_state = np.asarray(next_state)
-        done = np.asarray(done)
-        weights = np.asarray(weights)
-        inds = np.asarray(inds).flatten()
-
-        state = torch.from_numpy(state).float().to(self.device)
-        next_state = torch.from_numpy(next_state).float().to(self.device)
-        action = torch.from_numpy(action).float().to(self.device)
-        reward = torch.from_numpy(reward).float().to(self.device)
-        done = torch.from_numpy(done).float().to(self.device)
+        state = flatten_obs(state)
+        next_state = flatten_obs(next_state)
+        # discount of every transition, less than gamma ** n_step_return where the episode ended early
+        gamma = to_tensor(gamma, self.device)
+        weights = to_numpy(weights)
+        inds = to_numpy(inds).flatten()
+
+        if self.obs_stats is not None:
+            obs_rms = self.obs_stats.get()
+            state, next_state = obs_rms.normalize(state), obs_rms.normalize(next_state)
+
+        state = to_tensor(state, self.device)
+        next_state = to_tensor(next_state, self.device)
+        action = to_tensor(action, self.device)
+        reward = to_tensor(reward, self.device)
+        done = to_tensor(done, self.device)
 
         # ------- Update critic -------
-        # Predict next actions with target policy network
-        next_action = self.target_policy_net(next_state)
+        with self.precision.autocast():
+            # Predict next actions with target policy network
+            next_action = self.target_policy_net(next_state)
+
+            # Predict Z distribution with target value network
+            target_value = self.target_value_net.get_probs(next_state, next_action.detach())
 
-        # Predict Z distribution with target value network
-        target_value = self.target_value_net.get_probs(next_state, next_action.detach())
+            critic_value = self.value_net.get_probs(state, action)
+        # the projection and the loss stay in float32
+        target_value, critic_value = target_value.float(), critic_value.float()
 
         # Get projected distribution
-        target_z_projected = _l2_project(next_distr_v=target_value,
-                                         rewards_v=reward,
-                                         dones_mask_t=done,
-                                         gamma=self.gamma ** self.n_step_return,
-                                         n_atoms=self.num_atoms,
-                                         v_min=self.v_min,
-                                         v_max=self.v_max,
-                                         delta_z=self.delta_z)
-        target_z_projected = torch.from_numpy(target_z_projected).float().to(self.device)
-
-        critic_value = self.value_net.get_probs(state, action)
-        critic_value = critic_value.to(self.device)
+        target_z_projected = l2_project(next_distr=target_value,
+                                        rewards=reward,
+                                        dones=done,
+                                        gamma=gamma,
+                                        n_atoms=self.num_atoms,
+                                        v_min=self.v_min,
+                                        v_max=self.v_max,
+                                        delta_z=self.delta_z)
 
         value_loss = self.value_criterion(critic_value, target_z_projected)
         value_loss = value_loss.mean(axis=1)
@@ -97,66 +104,81 @@ class LearnerD4PG(object):
         # Update priorities in buffer
         td_error = value_loss.cpu().detach().numpy().flatten()
 
+        # non-finite TD errors must never reach the sampler as priorities, the update is skipped instead
+        finite = self.precision.check_finite(value_loss)
         if self.prioritized_replay:
-            weights_update = np.abs(td_error) + self.config['priority_epsilon']
-            replay_priority_queue.put((inds, weights_update))
+            if finite:
+                weights_update = np.abs(td_error) + self.config['priority_epsilon']
+                replay_priority_queue.put((inds, weights_update))
             value_loss = value_loss * torch.tensor(weights).float().to(self.device)
 
         # Update step
         value_loss = value_loss.mean()
         self.value_optimizer.zero_grad()
         value_loss.backward()
-        self.value_optimizer.step()
+        self.precision.step(self.value_optimizer, self.value_net.parameters())
 
         # -------- Update actor -----------
-        policy_loss = self.value_net.get_probs(state, self.policy_net(state))
-        policy_loss = policy_loss * torch.from_numpy(self.value_net.z_atoms).float().to(self.device)
+        with self.precision.autocast():
+            policy_loss = self.value_net.get_probs(state, self.policy_net(state))
+        policy_loss = policy_loss.float() * torch.from_numpy(self.value_net.z_atoms).float().to(self.device)
         policy_loss = torch.sum(policy_loss, dim=1)
         policy_loss = -policy_loss.mean()
 
         self.policy_optimizer.zero_grad()
         policy_loss.backward()
-        self.policy_optimizer.step()
+        self.precision.step(self.policy_optimizer, self.policy_net.parameters())
 
-        for target_param, param in zip(self.target_value_net.parameters(), self.value_net.parameters()):
-            target_param.data.copy_(target_param.data * (1.0 - self.tau) + param.data * self.tau)
+        self.target_updater.soft_update(self.tau)
 
-        for target_param, param in zip(self.target_policy_net.parameters(), self.policy_net.parameters()):
-            target_param.data.copy_(target_param.data * (1.0 - self.tau) + param.data * self.tau)
-
-        # Send updated learner to the queue
+        # Publish the policy to the agents
         if update_step.value % 100 == 0:
-            try:
-                params = [p.data.cpu().detach().numpy() for p in self.policy_net.parameters()]
-                self.learner_w_queue.put_nowait(params)
-            except:
-                pass
+            self.policy_weights.publish(self.policy_net)
+        if self.target_weights is not None and update_step.value % self.config['target_publish_interval'] == 0:
+            self.target_weights.publish(self.target_policy_net)
 
         # Logging
         with logs.get_lock():
             logs[3] = policy_loss.item()
             logs[4] = value_loss.item()
             logs[5] = time.time() - update_time
-
-    def run(self, training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs):
+            logs[self.precision_log] = self.precision.skipped_updates
+
+    def run(self, training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs, batch_slots=None,
+            ratio_controller=None):
+        """
+        :param batch_slots: SharedBatchSlots the sampler fills, the batch queue then only carries slot indexes
+        :param ratio_controller: ReplayRatioController that holds back updates running ahead of the agents
+        """
         torch.set_num_threads(4)
+        priority_updates = PriorityUpdateBatcher(replay_priority_queue)
         while logs[8] <= self.config['num_episodes']:
+            if ratio_controller is not None and not ratio_controller.learner_may_update():
+                time.sleep(0.001)
+                continue
             try:
                 batch = batch_queue.get_nowait()
             except queue.Empty:
                 time.sleep(0.01)
                 continue
 
-            self._update_step(batch, replay_priority_queue, update_step, logs)
-            with update_step.get_lock():
-                update_step.value += 1
-
-            if update_step.value % 10000 == 0:
-                print("Training step ", update_step.value)
+            if batch_slots is not None:
+                slot, seq = batch
+                batch = batch_slots.read(slot, seq)
+            # a message may hold several minibatches, their priority updates go back in one message
+            for minibatch in split_super_batch(batch, self.config['batches_per_message']):
+                self._update_step(minibatch, priority_updates, update_step, logs)
+                with update_step.get_lock():
+                    update_step.value += 1
+
+                if update_step.value % 10000 == 0:
+                    print("Training step ", update_step.value)
+            priority_updates.flush()
+            if batch_slots is not None:
+                batch_slots.release(slot)
 
         with training_on.get_lock():
             training_on.value = 0
 
-        empty_torch_queue(self.learner_w_queue)
         empty_torch_queue(replay_priority_queue)
         print("Exit learner.")
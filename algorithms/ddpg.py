@@ -1,4 +1,4 @@
-from utils.utils import empty_torch_queue
+from utils.utils import empty_torch_queue, split_super_batch, TargetUpdater
 from models import Critic
 import torch.nn.functional as F
 import torch.optim as optim
@@ -8,7 +8,7 @@ import time
 
 
 class LearnerDDPG(object):
-    def __init__(self, config, policy_net, target_policy_net, learner_w_queue, log_dir=''):
+    def __init__(self, config, policy_net, target_policy_net, policy_weights, log_dir='', target_weights=None):
         self.config = config
         self.update_iteration = config['update_agent_ep']
         self.batch_size = config['batch_size']
@@ -16,7 +16,9 @@ class LearnerDDPG(object):
         self.tau = config['tau']
         self.device = config['device']
         self.save_dir = log_dir
-        self.learner_w_queue = learner_w_queue
+        self.policy_weights = policy_weights  # SharedPolicyWeights read by the exploration agents
+        # SharedPolicyWeights of the target policy the exploitation agent acts with
+        self.target_weights = target_weights
         self.action_high = [1.5, 0.12]
 
         self.actor = policy_net
@@ -26,6 +28,7 @@ class LearnerDDPG(object):
         self.critic = Critic(config['state_dim'], config['action_dim'], config['dense_size']).to(self.device)
         self.critic_target = Critic(config['state_dim'], config['action_dim'], config['dense_size']).to(self.device)
         self.critic_target.load_state_dict(self.critic.state_dict())
+        self.target_updater = TargetUpdater((self.critic, self.critic_target), (self.actor, self.actor_target))
         self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=config['critic_learning_rate'])
 
         self.num_critic_update_iteration = 0
@@ -72,22 +75,16 @@ class LearnerDDPG(object):
         self.actor_optimizer.step()
 
         # Update the frozen target models
-        for param, target_param in zip(self.critic.parameters(), self.critic_target.parameters()):
-            target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
-
-        for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
-            target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
+        self.target_updater.soft_update(self.tau)
 
         self.num_actor_update_iteration += 1
         self.num_critic_update_iteration += 1
 
-        # Send updated learner to the queue
+        # Publish the policy to the agents
         if update_step.value % 100 == 0:
-            try:
-                params = [p.data.cpu().detach().numpy() for p in self.actor.parameters()]
-                self.learner_w_queue.put(params)
-            except:
-                pass
+            self.policy_weights.publish(self.actor)
+        if self.target_weights is not None and update_step.value % self.config['target_publish_interval'] == 0:
+            self.target_weights.publish(self.actor_target)
 
         # Logging
         with logs.get_lock():
@@ -95,25 +92,35 @@ class LearnerDDPG(object):
             logs[4] = actor_loss
             logs[5] = time.time() - update_time
 
-    def run(self, training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs):
+    def run(self, training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs, batch_slots=None,
+            ratio_controller=None):
+        """See LearnerD4PG.run."""
         torch.set_num_threads(4)
         while global_episode.value <= self.config['num_agents'] * self.config['num_episodes']:
+            if ratio_controller is not None and not ratio_controller.learner_may_update():
+                time.sleep(0.001)
+                continue
             try:
                 batch = batch_queue.get_nowait()
             except queue.Empty:
                 time.sleep(0.01)
                 continue
 
-            self._update_step(batch, update_step, logs)
-            with update_step.get_lock():
-                update_step.value += 1
+            if batch_slots is not None:
+                slot, seq = batch
+                batch = batch_slots.read(slot, seq)
+            for minibatch in split_super_batch(batch, self.config['batches_per_message']):
+                self._update_step(minibatch, update_step, logs)
+                with update_step.get_lock():
+                    update_step.value += 1
 
-            if update_step.value % 10000 == 0:
-                print("Training step ", update_step.value)
+                if update_step.value % 10000 == 0:
+                    print("Training step ", update_step.value)
+            if batch_slots is not None:
+                batch_slots.release(slot)
 
         with training_on.get_lock():
             training_on.value = 0
 
-        empty_torch_queue(self.learner_w_queue)
         empty_torch_queue(replay_priority_queue)
         print("Exit learner.")
\ No newline at end of file
@@ -1,4 +1,5 @@
-from utils.utils import empty_torch_queue, fast_clip_grad_norm, quantile_regression_loss
+from utils.utils import empty_torch_queue, fast_clip_grad_norm, quantile_regression_loss, flatten_obs, split_super_batch, \
+    to_tensor, to_numpy, PriorityUpdateBatcher, TargetUpdater, MixedPrecision
 from models import QuantileMlp
 import torch.optim as optim
 import numpy as np
@@ -10,7 +11,7 @@ import time
 class LearnerDSAC(object):
     """Policy and value network update routine. """
 
-    def __init__(self, config, policy_net, target_policy_net, learner_w_queue, log_dir=''):
+    def __init__(self, config, policy_net, target_policy_net, policy_weights, log_dir='', obs_stats=None, target_weights=None):
         self.config = config
         value_lr = config['critic_learning_rate']
         policy_lr = config['actor_learning_rate']
@@ -26,7 +27,11 @@ class LearnerDSAC(object):
         self.gamma = config['discount_rate']  # Discount rate (gamma) for future rewards
         self.log_dir = log_dir
         self.prioritized_replay = config['replay_memory_prioritized']
-        self.learner_w_queue = learner_w_queue
+        self.policy_weights = policy_weights  # SharedPolicyWeights read by the exploration agents
+        # SharedPolicyWeights of the target policy the exploitation agent acts with
+        self.target_weights = target_weights
+        # running state statistics published by the sampler, states are normalized with them when given
+        self.obs_stats = obs_stats
         self.delta_z = (self.v_max - self.v_min) / (self.num_atoms - 1)
         self._action_prior = config['action_prior']
         self.target_entropy = -config['action_dim']
@@ -47,12 +52,9 @@ class LearnerDSAC(object):
         self.policy_net = policy_net
         self.target_policy_net = target_policy_net
 
-        for target_param, param in zip(self.target_zf1.parameters(), self.zf1.parameters()):
-            target_param.data.copy_(param.data)
-        for target_param, param in zip(self.target_zf2.parameters(), self.zf2.parameters()):
-            target_param.data.copy_(param.data)
-        for target_param, param in zip(self.target_policy_net.parameters(), self.policy_net.parameters()):
-            target_param.data.copy_(param.data)
+        self.target_updater = TargetUpdater((self.zf1, self.target_zf1), (self.zf2, self.target_zf2),
+                                            (self.policy_net, self.target_policy_net))
+        self.target_updater.hard_update()
 
         self.use_automatic_entropy_tuning = config['use_automatic_entropy_tuning']
         if self.use_automatic_entropy_tuning:
@@ -71,6 +73,8 @@ class LearnerDSAC(object):
         self.discount = config['discount_rate']
         self.reward_scale = config['reward_scale']
         self.clip_norm = config['clip_norm']
+        self.precision = MixedPrecision(config['learner_precision'], self.device)
+        self.precision_log = 8 + 3 * config['num_agents']  # entry of the skipped updates in the shared logs
 
     def get_tau(self, actions):
         presum_tau = torch.zeros(len(actions), self.num_quantiles).to(self.device) + 1. / self.num_quantiles
@@ -83,34 +87,37 @@ class LearnerDSAC(object):
 
     def _update_step(self, batch, replay_priority_queue, update_step, logs):
         update_time = time.time()
+        self.precision.begin_update()
 
         obs, actions, rewards, next_obs, terminals, gamma, weights, inds = batch
-        obs = list(obs.values())
-        next_obs = list(next_obs.values())
-
-        obs = np.asarray(obs)
-        actions = np.asarray(actions)
-        rewards = np.asarray(rewards)
-        next_obs = np.asarray(next_obs)
-        terminals = np.asarray(terminals)
-        weights = np.asarray(weights)
-        inds = np.asarray(inds).flatten()
-
-        obs = torch.from_numpy(obs).float().to(self.device)
-        next_obs = torch.from_numpy(next_obs).float().to(self.device)
-        actions = torch.from_numpy(actions).float().to(self.device)
-        rewards = torch.from_numpy(rewards).float().to(self.device)
-        terminals = torch.from_numpy(terminals).float().to(self.device)
+        obs = flatten_obs(obs)
+        next_obs = flatten_obs(next_obs)
+        weights = to_numpy(weights)
+        inds = to_numpy(inds).flatten()
+
+        if self.obs_stats is not None:
+            obs_rms = self.obs_stats.get()
+            obs, next_obs = obs_rms.normalize(obs), obs_rms.normalize(next_obs)
+
+        obs = to_tensor(obs, self.device)
+        next_obs = to_tensor(next_obs, self.device)
+        actions = to_tensor(actions, self.device)
+        rewards = to_tensor(rewards, self.device)
+        terminals = to_tensor(terminals, self.device)
+        # discount of every transition (product over its N steps)
+        gamma = to_tensor(gamma, self.device)
 
         # ------- Update critic -------
         # Get predicted next-state actions and Q values from target models
-        new_actions, policy_mean, policy_log_std, log_pi, *_ = self.policy_net(obs, reparameterize=True,
-                                                                               return_log_prob=True)
+        with self.precision.autocast():
+            new_actions, policy_mean, policy_log_std, log_pi, *_ = self.policy_net(obs, reparameterize=True,
+                                                                                   return_log_prob=True)
+        new_actions, log_pi = new_actions.float(), log_pi.float()
         if self.use_automatic_entropy_tuning:
             alpha_loss = -(self.log_alpha.exp() * (log_pi + self.target_entropy).detach()).mean()
             self.alpha_optimizer.zero_grad()
             alpha_loss.backward()
-            self.alpha_optimizer.step()
+            self.precision.step(self.alpha_optimizer, [self.log_alpha])
             alpha = self.log_alpha.exp()
         else:
             alpha_loss = 0
@@ -118,16 +125,20 @@ class LearnerDSAC(object):
 
         # ------- Update ZF -------
         with torch.no_grad():
-            new_next_actions, _, _, new_log_pi, *_ = self.target_policy_net(next_obs, reparameterize=True, return_log_prob=True)
-            next_tau, next_tau_hat, next_presum_tau = self.get_tau(new_next_actions)
-            target_z1_values = self.target_zf1(next_obs, new_next_actions, next_tau_hat)
-            target_z2_values = self.target_zf2(next_obs, new_next_actions, next_tau_hat)
-            target_z_values = torch.min(target_z1_values, target_z2_values) - alpha * new_log_pi
-            z_target = self.reward_scale * rewards.unsqueeze(1) + (1. - terminals.unsqueeze(1)) * self.discount * target_z_values
+            with self.precision.autocast():
+                new_next_actions, _, _, new_log_pi, *_ = self.target_policy_net(next_obs, reparameterize=True, return_log_prob=True)
+                next_tau, next_tau_hat, next_presum_tau = self.get_tau(new_next_actions)
+                target_z1_values = self.target_zf1(next_obs, new_next_actions, next_tau_hat)
+                target_z2_values = self.target_zf2(next_obs, new_next_actions, next_tau_hat)
+            target_z_values = torch.min(target_z1_values.float(), target_z2_values.float()) - alpha * new_log_pi.float()
+            z_target = self.reward_scale * rewards.unsqueeze(1) + (1. - terminals.unsqueeze(1)) * gamma.unsqueeze(1) * target_z_values
 
         tau, tau_hat, presum_tau = self.get_tau(actions)
-        z1_pred = self.zf1(obs, actions, tau_hat)
-        z2_pred = self.zf2(obs, actions, tau_hat)
+        with self.precision.autocast():
+            z1_pred = self.zf1(obs, actions, tau_hat)
+            z2_pred = self.zf2(obs, actions, tau_hat)
+        # the quantile Huber losses stay in float32
+        z1_pred, z2_pred = z1_pred.float(), z2_pred.float()
         zf1_loss = self.zf_criterion(z1_pred, z_target, tau_hat, next_presum_tau)
         zf2_loss = self.zf_criterion(z2_pred, z_target, tau_hat, next_presum_tau)
         zf1_loss = zf1_loss.mean(axis=1)
@@ -135,10 +146,13 @@ class LearnerDSAC(object):
 
         # Update priorities in buffer 1
         value_loss = torch.min(zf1_loss, zf2_loss)
+        # non-finite TD errors must never reach the sampler as priorities, the update is skipped instead
+        finite = self.precision.check_finite(zf1_loss, zf2_loss)
         if self.prioritized_replay:
-            td_error = value_loss.cpu().detach().numpy().flatten()
-            weights_update = np.abs(td_error) + self.config['priority_epsilon']
-            replay_priority_queue.put((inds, weights_update))
+            if finite:
+                td_error = value_loss.cpu().detach().numpy().flatten()
+                weights_update = np.abs(td_error) + self.config['priority_epsilon']
+                replay_priority_queue.put((inds, weights_update))
             value_loss_1 = zf1_loss * torch.tensor(weights).float().to(self.device)
             value_loss_2 = zf2_loss * torch.tensor(weights).float().to(self.device)
             zf1_loss = value_loss_1.mean()
@@ -149,17 +163,18 @@ class LearnerDSAC(object):
 
         self.zf1_optimizer.zero_grad()
         zf1_loss.backward()
-        self.zf1_optimizer.step()
+        self.precision.step(self.zf1_optimizer, self.zf1.parameters())
         self.zf2_optimizer.zero_grad()
         zf2_loss.backward()
-        self.zf2_optimizer.step()
+        self.precision.step(self.zf2_optimizer, self.zf2.parameters())
 
         # ------- Update Policy -------
         with torch.no_grad():
             newtau, new_tau_hat, new_presum_tau = self.get_tau(new_actions)
 
-        z1_new_actions = self.zf1(obs, new_actions, new_tau_hat)
-        z2_new_actions = self.zf2(obs, new_actions, new_tau_hat)
+        with self.precision.autocast():
+            z1_new_actions = self.zf1(obs, new_actions, new_tau_hat).float()
+            z2_new_actions = self.zf2(obs, new_actions, new_tau_hat).float()
         q1_new_actions = torch.sum(new_presum_tau * z1_new_actions, dim=1, keepdim=True)
         q2_new_actions = torch.sum(new_presum_tau * z2_new_actions, dim=1, keepdim=True)
         q_new_actions = torch.min(q1_new_actions, q2_new_actions)
@@ -168,50 +183,58 @@ class LearnerDSAC(object):
         self.policy_optimizer.zero_grad()
         policy_loss.backward()
         policy_grad = fast_clip_grad_norm(self.policy_net.parameters(), self.clip_norm)
-        self.policy_optimizer.step()
+        self.precision.step(self.policy_optimizer, self.policy_net.parameters())
 
-        for target_param, param in zip(self.target_zf1.parameters(), self.zf1.parameters()):
-            target_param.data.copy_(target_param.data * (1.0 - self.beta) + param.data * self.beta)
+        self.target_updater.soft_update(self.beta)
 
-        for target_param, param in zip(self.target_zf2.parameters(), self.zf2.parameters()):
-            target_param.data.copy_(target_param.data * (1.0 - self.beta) + param.data * self.beta)
-
-        for target_param, param in zip(self.target_policy_net.parameters(), self.policy_net.parameters()):
-            target_param.data.copy_(target_param.data * (1.0 - self.beta) + param.data * self.beta)
-
-        # Send updated learner to the queue
+        # Publish the policy to the agents
         if update_step.value % 100 == 0:
-            try:
-                params = [p.data.cpu().detach().numpy() for p in self.policy_net.parameters()]
-                self.learner_w_queue.put(params)
-            except:
-                pass
+            self.policy_weights.publish(self.policy_net)
+        if self.target_weights is not None and update_step.value % self.config['target_publish_interval'] == 0:
+            self.target_weights.publish(self.target_policy_net)
 
         # Logging
         with logs.get_lock():
             logs[3] = policy_loss.item()
             logs[4] = value_loss.mean().item()
             logs[5] = time.time() - update_time
-
-    def run(self, training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs):
+            logs[self.precision_log] = self.precision.skipped_updates
+
+    def run(self, training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs, batch_slots=None,
+            ratio_controller=None):
+        """
+        :param batch_slots: SharedBatchSlots the sampler fills, the batch queue then only carries slot indexes
+        :param ratio_controller: ReplayRatioController that holds back updates running ahead of the agents
+        """
         torch.set_num_threads(4)
+        priority_updates = PriorityUpdateBatcher(replay_priority_queue)
         while global_episode.value <= self.config['num_agents'] * self.config['num_episodes']:
+            if ratio_controller is not None and not ratio_controller.learner_may_update():
+                time.sleep(0.001)
+                continue
             try:
                 batch = batch_queue.get_nowait()
             except queue.Empty:
                 time.sleep(0.01)
                 continue
 
-            self._update_step(batch, replay_priority_queue, update_step, logs)
-            with update_step.get_lock():
-                update_step.value += 1
-
-            if update_step.value % 10000 == 0:
-                print("Training step ", update_step.value)
+            if batch_slots is not None:
+                slot, seq = batch
+                batch = batch_slots.read(slot, seq)
+            # a message may hold several minibatches, their priority updates go back in one message
+            for minibatch in split_super_batch(batch, self.config['batches_per_message']):
+                self._update_step(minibatch, priority_updates, update_step, logs)
+                with update_step.get_lock():
+                    update_step.value += 1
+
+                if update_step.value % 10000 == 0:
+                    print("Training step ", update_step.value)
+            priority_updates.flush()
+            if batch_slots is not None:
+                batch_slots.release(slot)
 
         with training_on.get_lock():
             training_on.value = 0
 
-        empty_torch_queue(self.learner_w_queue)
         empty_torch_queue(replay_priority_queue)
         print("Exit learner.")
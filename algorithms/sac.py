@@ -1,4 +1,4 @@
-from utils.utils import empty_torch_queue
+from utils.utils import empty_torch_queue, split_super_batch, TargetUpdater
 from models import Critic, Q
 from torch.distributions import Normal
 import torch.optim as optim
@@ -9,7 +9,7 @@ import time
 
 
 class LearnerSAC(object):
-    def __init__(self, config, policy_net, target_policy_net, learner_w_queue, log_dir=''):
+    def __init__(self, config, policy_net, target_policy_net, policy_weights, log_dir='', target_weights=None):
         self.config = config
         self.update_iteration = config['update_agent_ep']
         self.batch_size = config['batch_size']
@@ -17,9 +17,12 @@ class LearnerSAC(object):
         self.tau = config['tau']
         self.device = config['device']
         self.save_dir = log_dir
-        self.learner_w_queue = learner_w_queue
+        self.policy_weights = policy_weights  # SharedPolicyWeights read by the exploration agents
+        # SharedPolicyWeights of the target policy the exploitation agent acts with
+        self.target_weights = target_weights
 
         self.actor = policy_net
+        self.actor_target = target_policy_net
         self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=config['actor_learning_rate'])
         self.critic = Critic(config['state_dim'], config['action_dim'], config['dense_size']).to(self.device)
         self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=config['critic_learning_rate'])
@@ -32,10 +35,8 @@ class LearnerSAC(object):
         self.Q_criterion = nn.MSELoss()
         self.num_training = 0
 
-        for target_param, param in zip(self.critic_target.parameters(), self.critic.parameters()):
-            target_param.data.copy_(param.data)
-        for target_param, param in zip(self.target_policy_net.parameters(), self.actor.parameters()):
-            target_param.data.copy_(param.data)
+        self.target_updater = TargetUpdater((self.critic, self.critic_target), (self.actor, self.actor_target))
+        self.target_updater.hard_update()
 
     def select_action(self, state):
         state = torch.FloatTensor(state).to(self.device)
@@ -56,11 +57,11 @@ class LearnerSAC(object):
         log_prob = dist.log_prob(z) - torch.log(1 - action.pow(2) + min_Val)
         return action, log_prob, z, batch_mu, batch_log_sigma
 
-    def _update_step(self, replay_buffer, update_step, logs):
+    def _update_step(self, batch, update_step, logs):
         update_time = time.time()
 
-        # Sample replay buffer
-        x, u, r, y, d, _ = replay_buffer.sample(self.batch_size)
+        # Minibatch in the layout of the replay buffers, the sampler already drew it
+        x, u, r, y, d, gamma, weights, inds = batch
         state = torch.FloatTensor(x).to(self.device)
         next_state = torch.FloatTensor(y).to(self.device)
         action = torch.FloatTensor(u).to(self.device)
@@ -116,41 +117,45 @@ class LearnerSAC(object):
         self.actor_optimizer.step()
 
         # soft update
-        for target_param, param in zip(self.critic_target.parameters(), self.critic.parameters()):
-            target_param.data.copy_(target_param * (1 - self.config['tau']) + param * self.config['tau'])
+        self.target_updater.soft_update(self.config['tau'])
 
-        for target_param, param in zip(self.actor_target.parameters(), self.actor.parameters()):
-            target_param.data.copy_(target_param * (1 - self.config['tau']) + param * self.config['tau'])
-
-        # Send updated learner to the queue
+        # Publish the policy to the agents
         if update_step.value % 100 == 0:
-            try:
-                params = [p.data.cpu().detach().numpy() for p in self.actor.parameters()]
-                self.learner_w_queue.put(params)
-            except:
-                pass
+            self.policy_weights.publish(self.actor)
+        if self.target_weights is not None and update_step.value % self.config['target_publish_interval'] == 0:
+            self.target_weights.publish(self.actor_target)
 
         self.num_training += 1
 
-    def run(self, training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs):
+    def run(self, training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs, batch_slots=None,
+            ratio_controller=None):
+        """See LearnerD4PG.run."""
         torch.set_num_threads(4)
         while global_episode.value <= self.config['num_agents'] * self.config['num_episodes']:
+            if ratio_controller is not None and not ratio_controller.learner_may_update():
+                time.sleep(0.001)
+                continue
             try:
                 batch = batch_queue.get_nowait()
             except queue.Empty:
                 time.sleep(0.01)
                 continue
 
-            self._update_step(batch, update_step, logs)
-            with update_step.get_lock():
-                update_step.value += 1
+            if batch_slots is not None:
+                slot, seq = batch
+                batch = batch_slots.read(slot, seq)
+            for minibatch in split_super_batch(batch, self.config['batches_per_message']):
+                self._update_step(minibatch, update_step, logs)
+                with update_step.get_lock():
+                    update_step.value += 1
 
-            if update_step.value % 10000 == 0:
-                print("Training step ", update_step.value)
+                if update_step.value % 10000 == 0:
+                    print("Training step ", update_step.value)
+            if batch_slots is not None:
+                batch_slots.release(slot)
 
         with training_on.get_lock():
             training_on.value = 0
 
-        empty_torch_queue(self.learner_w_queue)
         empty_torch_queue(replay_priority_queue)
         print("Exit learner.")
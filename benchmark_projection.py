@@ -0,0 +1,56 @@
+#! /usr/bin/env python3
+
+from utils.l2_projection import _l2_project, l2_project
+import numpy as np
+import argparse
+import torch
+import time
+import yaml
+import os
+
+# Loading configs from config.yaml
+path = os.path.dirname(os.path.abspath(__file__))
+with open(path + '/config.yml', 'r') as ymlfile:
+    config = yaml.load(ymlfile, Loader=yaml.FullLoader)
+
+parser = argparse.ArgumentParser(description="Time the numpy and torch categorical projections of D4PG")
+parser.add_argument('--batch-size', type=int, default=config['batch_size'])
+parser.add_argument('--repeats', type=int, default=200)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+args = parser.parse_args()
+
+
+def timeit(fn, repeats):
+    fn()  # warm up
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+v_min, v_max = config['v_min'], config['v_max']
+gamma = config['discount_rate'] ** config['n_step_return']
+print(f"batch {args.batch_size} on {args.device}")
+for num_atoms in (51, 101, 201):
+    delta_z = (v_max - v_min) / (num_atoms - 1)
+    next_distr = torch.softmax(torch.randn(args.batch_size, num_atoms, device=args.device), dim=1)
+    rewards = torch.randn(args.batch_size, device=args.device) * (v_max - v_min) / 4
+    dones = (torch.rand(args.batch_size, device=args.device) < 0.1).float()
+    gammas = torch.full((args.batch_size,), gamma, device=args.device)
+
+    def numpy_projection():
+        # what the learner did before: project on the CPU and copy the result back to the device
+        projected = _l2_project(next_distr, rewards, dones, gammas.cpu().numpy(), delta_z, num_atoms, v_min, v_max)
+        return torch.from_numpy(projected).float().to(args.device)
+
+    def torch_projection():
+        return l2_project(next_distr, rewards, dones, gammas, delta_z, num_atoms, v_min, v_max)
+
+    error = (numpy_projection() - torch_projection()).abs().max().item()
+    numpy_time, torch_time = timeit(numpy_projection, args.repeats), timeit(torch_projection, args.repeats)
+    print(f"atoms {num_atoms:4d}: numpy {1e3 * numpy_time:7.3f} ms  torch {1e3 * torch_time:7.3f} ms  "
+          f"speedup {numpy_time / torch_time:6.1f}x  max abs diff {error:.2e}")
@@ -4,6 +4,7 @@ import rospy
 from utils import range_finder as rf
 import gym_turtlebot3
 from models import PolicyNetwork, TanhGaussianPolicy
+from utils.running_stats import RunningMeanStd, obs_rms_path
 from utils.defisheye import Defisheye
 from algorithms.bug2 import BUG2
 from sensor_msgs.msg import Image
@@ -117,6 +118,8 @@ while True:
             actor = torch.load(model_fn)
             actor.to(config['device'])
         actor.eval()
+        # state statistics the policy was trained with, when the states were normalized
+        obs_rms = RunningMeanStd.load(obs_rms_path(model_fn)) if config['obs_normalization'] else None
     else:
         b2 = BUG2()
 
@@ -149,10 +152,11 @@ while True:
             # state[-2] = -state[-2]
 
             if algorithm != '7':
+                state_net = obs_rms.normalize(state) if obs_rms is not None else state
                 if algorithm == '2' or algorithm == '4':
-                    action, _, _, _, _, _, _, _ = actor.forward(torch.Tensor(state).to(config['device']), deterministic=True)
+                    action, _, _, _, _, _, _, _ = actor.forward(torch.Tensor(state_net).to(config['device']), deterministic=True)
                 else:
-                    action = actor.get_action(np.array(state))
+                    action = actor.get_action(np.array(state_net))
                 action = action.detach().cpu().numpy().flatten()
             else:
                 action = b2.get_action(state)
@@ -0,0 +1,32 @@
+from utils.compact_storage import CompactArray
+import numpy as np
+import unittest
+
+
+class CompactArrayTest(unittest.TestCase):
+    def test_requantization_error_is_bounded(self):
+        rng = np.random.default_rng(0)
+        for dtype in ('int8', 'uint16'):
+            array = CompactArray((512, 3), dtype)
+            reference = np.zeros((512, 3), dtype=np.float32)
+            # a range that keeps growing, written around the ring several times
+            for i in range(200):
+                idxes = (np.arange(8) + 8 * i) % 512
+                value = (rng.standard_normal((8, 3)) * (1 + i / 10)).astype(np.float32)
+                array[idxes] = value
+                reference[idxes] = value
+            step = (array.high - array.low) / (np.iinfo(dtype).max - np.iinfo(dtype).min)
+            bound = (1 + array.headroom) / (2 * array.headroom) + 0.5
+            self.assertTrue(np.all(np.abs(array[np.arange(512)] - reference) <= bound * step + 1e-6))
+
+    def test_only_written_rows_are_reencoded(self):
+        array = CompactArray((100, 2), 'int8')
+        array[np.arange(4)] = np.ones((4, 2))
+        array[4] = np.full(2, 10.0)
+        self.assertEqual(array.num_rows, 5)
+        np.testing.assert_array_equal(array.codes[5:], 0)
+        np.testing.assert_allclose(array[np.arange(5)][:, 0], [1, 1, 1, 1, 10], atol=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
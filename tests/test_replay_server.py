@@ -0,0 +1,65 @@
+from utils.replay_server import ReplayServer, ReplayClient, parse_address
+from utils.utils import PrioritizedArrayReplayBuffer, stack_transitions
+import numpy as np
+import unittest
+import socket
+
+STATE_DIM, ACTION_DIM = 4, 2
+
+
+def make_columns(num, offset=0):
+    return stack_transitions([(np.full(STATE_DIM, offset + i, dtype=np.float32), np.zeros(ACTION_DIM), offset + i,
+                               np.full(STATE_DIM, offset + i + 1, dtype=np.float32), 0.0, 0.99)
+                              for i in range(num)])
+
+
+class ReplayServerTest(unittest.TestCase):
+    """Round trip through a server listening on localhost."""
+    def setUp(self):
+        buffer = PrioritizedArrayReplayBuffer(64, STATE_DIM, ACTION_DIM, alpha=0.6)
+        self.server = ReplayServer(buffer, '127.0.0.1:0').start()
+        host, port = self.server.address
+        self.client = ReplayClient(f"{host}:{port}")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_default_host_is_localhost(self):
+        self.assertEqual(parse_address(':7878'), (socket.AF_INET, ('127.0.0.1', 7878)))
+        self.assertEqual(self.server.address[0], '127.0.0.1')
+
+    def test_insert_sample_update_priorities(self):
+        batch = make_columns(40)
+        stats = self.client.insert({key: batch[key] for key in batch.dtype.names})
+        self.assertEqual(stats, {'size': 40, 'num_added': 40})
+
+        obs, action, reward, next_obs, done, gamma, weights, idxes = self.client.sample(16, beta=0.4)
+        self.assertEqual(obs.shape, (16, STATE_DIM))
+        self.assertEqual(action.shape, (16, ACTION_DIM))
+        # every sampled transition is the one stored at its index
+        np.testing.assert_array_equal(reward, idxes)
+        np.testing.assert_array_equal(obs[:, 0], reward)
+        np.testing.assert_array_equal(next_obs[:, 0], reward + 1)
+        self.assertTrue(np.all(weights > 0) and np.all(weights <= 1))
+
+        # all the probability mass on one transition
+        priorities = np.full(40, 1e-6)
+        priorities[7] = 1e3
+        self.client.update_priorities(np.arange(40), priorities)
+        reward = self.client.sample(16, beta=0.4)[2]
+        self.assertGreater(np.mean(reward == 7), 0.9)
+
+    def test_capacity(self):
+        for offset in range(0, 100, 20):
+            self.client.add_batch(make_columns(20, offset))
+        self.assertEqual(len(self.client), 64)
+        self.assertEqual(self.client.num_added, 100)
+
+    def test_errors_are_reported(self):
+        with self.assertRaises(RuntimeError):
+            self.client.update_priorities([0], [-1.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,15 @@ try:
     set_start_method('spawn')
 except:
     pass
-from utils.utils import empty_torch_queue, create_replay_buffer
+from utils.utils import empty_torch_queue, create_replay_buffer, insert_replay, replay_states, stack_batches
+from utils.shared_memory import SharedReplayStorage, SharedBatchSlots, SharedPriorityRing, SharedObsStats, \
+    SharedPolicyWeights
+from utils.running_stats import RunningMeanStd, FixedObsStats, obs_rms_path
+from utils.replay_io import has_columns, ReplaySnapshotWriter, load_segments
+from utils.sharding import shard_batch, shard_sizes, ShardedBatchQueue, ShardedPriorityQueue
+from utils.flow_control import ReplayRatioController, NotifyingQueue
+from utils.replay_server import ReplayClient
+from utils.learner_replay import LearnerReplayBuffer
 from algorithms.dsac import LearnerDSAC
 from algorithms.d4pg import LearnerD4PG
 from algorithms.ddpg import LearnerDDPG
@@ -25,63 +33,143 @@ from models import PolicyNetwork, TanhGaussianPolicy, PolicyNetwork2
 from agent import Agent
 
 
-def sampler_worker(config, replay_queue, batch_queue, replay_priorities_queue, training_on, global_episode, logs, experiment_dir):
+def sampler_worker(config, replay_queue, batch_queue, replay_priorities_queue, training_on, global_episode, logs,
+                   experiment_dir, replay_storage=None, batch_slots=None, shard=0, num_shards=1, obs_stats=None,
+                   wakeup=None):
     torch.set_num_threads(4)
-    # Create replay buffer
-    replay_buffer = create_replay_buffer(config, experiment_dir)
-    batch_size = config['batch_size']
-
+    if num_shards > 1:
+        # every shard owns its part of the replay memory and serves its part of each batch
+        config = dict(config, replay_mem_size=config['replay_mem_size'] // num_shards)
+    # Create replay buffer, or connect to the one of a replay server shared with other runs
+    if config['replay_server']:
+        replay_buffer = ReplayClient(config['replay_server'])
+    else:
+        replay_buffer = create_replay_buffer(config, experiment_dir, shared_storage=replay_storage)
+    batch_size = shard_sizes(config['batch_size'], num_shards)[shard]
+    # horizon of the N-step returns built by the replay buffer, the agents then only send 1-step transitions
+    sample_kwargs = {'n_step': config['n_step_return']} if config['replay_sample_n_step'] else {}
+    buffer_dir = f"{experiment_dir}/{config['model']}_{config['dense_size']}_A{config['num_agents']}_Manipulation_{'P' if config['replay_memory_prioritized'] else 'N'}/"
+    if num_shards > 1:
+        buffer_dir = os.path.join(buffer_dir, f"shard_{shard}/")
+    if config['load_buffer'] and has_columns(os.path.join(buffer_dir, "replay_buffer")):
+        replay_buffer.load(buffer_dir)
+        print(f"Resumed replay buffer from {buffer_dir} with {len(replay_buffer)} transitions")
+    elif config['load_buffer']:
+        num_loaded = load_segments(os.path.join(buffer_dir, "replay_segments"), replay_buffer,
+                                   capacity=config['replay_mem_size'])
+        print(f"Resumed replay buffer from snapshots in {buffer_dir} with {num_loaded} transitions")
+    # running statistics of the states this shard received, published for the learner and the agents
+    obs_rms = None
+    if obs_stats is not None:
+        obs_rms = RunningMeanStd(config['state_dim'])
+        if len(replay_buffer) > 0 and not config['replay_server']:
+            obs_rms.update(replay_buffer.get_recent(len(replay_buffer))['obs'])
+            obs_stats.publish(shard, obs_rms)
+
+    def insert(replay):
+        insert_replay(replay_buffer, replay)
+        if obs_rms is not None:
+            obs_rms.update(replay_states(replay))
+
+    snapshot_writer = None
+    if config['replay_snapshot_interval']:
+        snapshot_writer = ReplaySnapshotWriter(os.path.join(buffer_dir, "replay_segments"), replay_buffer,
+                                               config['replay_mem_size'])
+
+    sampler_log = 6 + 3 * config['num_agents']
+    idle_time, work_time, num_batches, report_time = 0.0, 0.0, 0, time.time()
     while training_on.value:
+        work_start = time.perf_counter()
+        # whatever the agents or the learner do from here on wakes up the idle wait below
+        wakeup.clear()
         # (1) Transfer replays to global buffer
-        time.sleep(0.1)
-        n = replay_queue.qsize()
-
-        for _ in range(n):
-            replay = replay_queue.get()
-            replay_buffer.add(*replay)
-
-        # (2) Transfer batch of replay from buffer to the batch_queue
-        if len(replay_buffer) < batch_size:
-            continue
-
-        try:
-            if config['replay_memory_prioritized']:
-                inds, weights = replay_priorities_queue.get_nowait()
-                replay_buffer.update_priorities(inds, weights)
-        except queue.Empty:
-            pass
+        if replay_storage is not None:
+            # agents already wrote their transitions in place, only pick up the committed ones
+            num_new = replay_buffer.sync()
+            if obs_rms is not None and num_new > 0:
+                obs_rms.update(replay_buffer.get_recent(num_new)['obs'])
+        else:
+            num_new = 0
+            for _ in range(replay_queue.qsize()):
+                insert(replay_queue.get())
+                num_new += 1
+        if obs_rms is not None and num_new > 0:
+            obs_stats.publish(shard, obs_rms)
+        if snapshot_writer is not None:
+            snapshot_writer.maybe_flush(replay_buffer, config['replay_snapshot_interval'])
+
+        # (2) Keep the batch queue topped up to its target depth
+        num_sent = 0
+        if len(replay_buffer) >= batch_size:
+            if isinstance(replay_priorities_queue, SharedPriorityRing):
+                # everything the learner published so far, as one batched tree update
+                inds, weights = replay_priorities_queue.drain()
+                if len(inds) > 0:
+                    replay_buffer.update_priorities(inds, weights)
+            elif config['replay_memory_prioritized']:
+                for _ in range(replay_priorities_queue.qsize()):
+                    inds, weights = replay_priorities_queue.get()
+                    replay_buffer.update_priorities(inds, weights)
 
-        try:
             if logs[8] >= config['num_episodes']:
                 beta = config['priority_beta_end']
             else:
                 beta = config['priority_beta_start'] + (config['priority_beta_end']-config['priority_beta_start']) * (logs[8] / config['num_episodes'])
-            batch = replay_buffer.sample(batch_size, beta=beta)
-            batch_queue.put_nowait(batch)
+            while batch_queue.qsize() < config['batch_queue_depth']:
+                try:
+                    if config['batches_per_message'] > 1:
+                        # super-batch of independent minibatches, the learner runs them back-to-back
+                        batch = stack_batches([replay_buffer.sample(batch_size, beta=beta, **sample_kwargs)
+                                               for _ in range(config['batches_per_message'])])
+                    else:
+                        batch = replay_buffer.sample(batch_size, beta=beta, **sample_kwargs)
+                except queue.Empty:
+                    break  # the agents are rewriting every stored slot of the shared ring
+                if num_shards > 1:
+                    min_probability = replay_buffer.min_probability() if config['replay_memory_prioritized'] else None
+                    batch = shard_batch(batch, shard, num_shards, min_probability, beta)
+                if batch_slots is not None:
+                    # only the slot index goes through the queue, the batch is written in place
+                    batch = batch_slots.write(batch)
+                    if batch is None:
+                        break
+                try:
+                    batch_queue.put_nowait(batch)
+                except queue.Full:
+                    break
+                num_sent += 1
             if len(replay_buffer) > config['replay_mem_size']:
                 replay_buffer.remove(len(replay_buffer)-config['replay_mem_size'])
-        except:
-            time.sleep(0.1)
-            continue
-
-        try:
-            # Log data structures sizes
+        work_time += time.perf_counter() - work_start
+        num_batches += num_sent
+
+        # (3) Nothing to do, block until new data arrives or the learner takes a batch (the timeout only
+        # rechecks training_on)
+        if num_new == 0 and num_sent == 0:
+            idle_start = time.perf_counter()
+            wakeup.wait(timeout=0.1)
+            idle_time += time.perf_counter() - idle_start
+
+        if shard == 0 and time.time() - report_time >= 1.0:
+            # Log data structures sizes and how busy the sampler is (of the first shard when sharded)
             with logs.get_lock():
-                logs[0] = replay_queue.qsize()
+                logs[0] = replay_queue.qsize() if replay_storage is None else 0
                 logs[1] = batch_queue.qsize()
                 logs[2] = len(replay_buffer)
-        except:
-            pass
+                logs[sampler_log] = idle_time / max(idle_time + work_time, 1e-9)
+                logs[sampler_log + 1] = num_batches / (time.time() - report_time)
+            idle_time, work_time, num_batches, report_time = 0.0, 0.0, 0, time.time()
 
+    if snapshot_writer is not None:
+        snapshot_writer.close()
     if config['save_buffer']:
-        process_dir = f"{experiment_dir}/{config['model']}_{config['dense_size']}_A{config['num_agents']}_S{config['env_stage']}_{'P' if config['replay_memory_prioritized'] else 'N'}/"
-        replay_buffer.dump(process_dir)
+        replay_buffer.dump(buffer_dir)
 
     empty_torch_queue(batch_queue)
     print("Stop sampler worker.")
 
 
-def logger(config, logs, training_on, update_step, global_episode, global_step, log_dir):
+def logger(config, logs, training_on, update_step, global_episode, global_step, log_dir, ratio_controller=None):
     # Initialize the SummaryWriter
     os.environ['COMET_API_KEY'] = config['api_key']
     comet_ml.init(project_name=config['project_name'])
@@ -90,6 +178,10 @@ def logger(config, logs, training_on, update_step, global_episode, global_step,
     num_agents = config['num_agents']
     fake_local_eps = np.zeros(num_agents, dtype=np.int)
     fake_step = 0
+    if ratio_controller is None:
+        # the replay ratio is logged even when it is not enforced
+        ratio_controller = ReplayRatioController(config['replay_ratio'], config['replay_ratio_tolerance'],
+                                                 config['replay_ratio_warmup'], global_step, update_step)
     print("Starting log...")
     while (global_episode.value < config['test_trials']) if config['test'] else (logs[8] <= config['num_episodes']):
         try:
@@ -97,7 +189,11 @@ def logger(config, logs, training_on, update_step, global_episode, global_step,
                 step = update_step.value
                 writer.add_scalars(main_tag="data_struct", tag_scalar_dict={"global_episode": global_episode.value,
                                    "global_step": global_step.value, "replay_queue": logs[0], "batch_queue": logs[1],
-                                   "replay_buffer": logs[2]}, global_step=step)
+                                   "replay_buffer": logs[2], "sampler_idle": logs[6 + 3 * num_agents],
+                                   "sampler_batches_per_s": logs[7 + 3 * num_agents],
+                                   "learner_skipped_updates": logs[8 + 3 * num_agents],
+                                   "replay_ratio": ratio_controller.achieved_ratio()},
+                                   global_step=step)
                 if fake_step != step:
                     fake_step = step
                     writer.add_scalars(main_tag="losses", tag_scalar_dict={"policy_loss": logs[3], "value_loss": logs[4],
@@ -128,24 +224,34 @@ def logger(config, logs, training_on, update_step, global_episode, global_step,
     print("Writer closed!")
 
 
-def learner_worker(config, training_on, policy, target_policy_net, learner_w_queue, replay_priority_queue, batch_queue,
-                   update_step, global_episode, logs, experiment_dir):
+def learner_worker(config, training_on, policy, target_policy_net, policy_weights, replay_priority_queue, batch_queue,
+                   update_step, global_episode, logs, experiment_dir, batch_slots=None, ratio_controller=None,
+                   obs_stats=None, replay_storage=None, target_weights=None):
+    if config['replay_learner_resident']:
+        # the learner samples its own batches from what the agents wrote into the shared storage
+        batch_queue = LearnerReplayBuffer(replay_storage, config['batch_size'], config['device'], obs_stats)
     if config['model'] == 'PDDRL':
-        learner = LearnerD4PG(config, policy, target_policy_net, learner_w_queue, log_dir=experiment_dir)
+        learner = LearnerD4PG(config, policy, target_policy_net, policy_weights, log_dir=experiment_dir,
+                              obs_stats=obs_stats, target_weights=target_weights)
     elif config['model'] == 'PDSRL':
-        learner = LearnerDSAC(config, policy, target_policy_net, learner_w_queue, log_dir=experiment_dir)
+        learner = LearnerDSAC(config, policy, target_policy_net, policy_weights, log_dir=experiment_dir,
+                              obs_stats=obs_stats, target_weights=target_weights)
     elif config['model'] == 'DDPG':
-        learner = LearnerDDPG(config, policy, target_policy_net, learner_w_queue, log_dir=experiment_dir)
+        learner = LearnerDDPG(config, policy, target_policy_net, policy_weights, log_dir=experiment_dir,
+                              target_weights=target_weights)
     elif config['model'] == 'SAC':
-        learner = LearnerSAC(config, policy, target_policy_net, learner_w_queue, log_dir=experiment_dir)
-    learner.run(training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs)
+        learner = LearnerSAC(config, policy, target_policy_net, policy_weights, log_dir=experiment_dir,
+                             target_weights=target_weights)
+    learner.run(training_on, batch_queue, replay_priority_queue, update_step, global_episode, logs,
+                batch_slots=batch_slots, ratio_controller=ratio_controller)
 
 
-def agent_worker(config, policy, learner_w_queue, global_episode, i, agent_type, experiment_dir, training_on,
-                 replay_queue, logs, global_step):
+def agent_worker(config, policy, policy_weights, global_episode, i, agent_type, experiment_dir, training_on,
+                 replay_queue, logs, global_step, ratio_controller=None, obs_stats=None):
     agent = Agent(config=config, policy=policy, global_episode=global_episode, n_agent=i, agent_type=agent_type,
-                  log_dir=experiment_dir, global_step=global_step)
-    agent.run(training_on, replay_queue, learner_w_queue, logs)
+                  log_dir=experiment_dir, global_step=global_step, ratio_controller=ratio_controller,
+                  obs_stats=obs_stats)
+    agent.run(training_on, replay_queue, policy_weights, logs)
 
 
 if __name__ == "__main__":
@@ -176,21 +282,81 @@ if __name__ == "__main__":
     update_step = mp.Value('i', 0)
     global_episode = mp.Value('i', 0)
     global_step = mp.Value('i', 0)
-    logs = mp.Array('d', np.zeros(6 + 3 * config['num_agents']))
-    learner_w_queue = torch_mp.Queue(maxsize=config['num_agents'])
+    logs = mp.Array('d', np.zeros(6 + 3 * config['num_agents'] + 3))
     replay_priorities_queue = mp.Queue(maxsize=config['replay_queue_size'])
+    # one replay and priority queue per sampler shard, the exploration agents are spread over the shards
+    num_shards = config['num_sampler_shards']
+    assert num_shards == 1 or not (config['replay_memory_shared'] or config['batch_slots']), \
+        "Sampler shards use their own replay and batch queues"
+    assert num_shards < config['num_agents'], "Every sampler shard needs an exploration agent"
+    assert not config['replay_server'] or not (num_shards > 1 or config['replay_memory_shared'] or config['save_buffer']
+                                               or config['load_buffer'] or config['replay_snapshot_interval']), \
+        "The replay server owns the replay memory, it is not sharded, shared or saved by this run"
+    # the agents start writing into a shared ring from sequence 0 while the sampler restores, a restored window
+    # would be overwritten from its first slot and no longer match the ring pointers
+    assert not config['load_buffer'] or not (config['replay_memory_shared'] or config['replay_learner_resident']), \
+        "A shared memory replay buffer cannot be resumed, the agents write into it from the start"
+    # the sampler of a shard sleeps on its event, set by the agents sending transitions and the learner taking batches
+    sampler_wakeups = [mp.Event() for _ in range(num_shards)]
+    replay_queues = [replay_queue] + [mp.Queue(maxsize=config['replay_queue_size']) for _ in range(num_shards - 1)]
+    replay_queues = [NotifyingQueue(q, wakeup, notify='put') for q, wakeup in zip(replay_queues, sampler_wakeups)]
+    replay_queue = replay_queues[0]
+    priorities_queues = [replay_priorities_queue] + [mp.Queue(maxsize=config['replay_queue_size'])
+                                                     for _ in range(num_shards - 1)]
+    if config['replay_priorities_shared'] and config['replay_memory_prioritized'] and not config['test']:
+        # room for the updates of every batch that can be in flight
+        priorities_queues = [SharedPriorityRing(2 * config['batch_queue_size'] * config['batch_size'])
+                             for _ in range(num_shards)]
+        replay_priorities_queue = priorities_queues[0]
+    ratio_controller = None
+    if config['replay_ratio'] and not config['test']:
+        ratio_controller = ReplayRatioController(config['replay_ratio'], config['replay_ratio_tolerance'],
+                                                 config['replay_ratio_warmup'], global_step, update_step)
+    learner_resident = config['replay_learner_resident'] and not config['test']
+    assert not learner_resident or not (config['replay_memory_prioritized'] or config['her_memory']
+                                        or config['replay_memory_dedup'] or config['replay_sample_n_step']
+                                        or config['replay_server'] or num_shards > 1 or config['batch_slots']
+                                        or config['batches_per_message'] > 1), \
+        "The learner resident replay buffer samples uniform single batches of agent side N-step transitions"
+    replay_storage = None
+    if (config['replay_memory_shared'] or learner_resident) and not config['test']:
+        replay_storage = SharedReplayStorage(config['replay_mem_size'], config['state_dim'], config['action_dim'],
+                                             headroom=config['num_agents'], wakeup=sampler_wakeups[0])
+    obs_stats = None
+    if config['obs_normalization'] and not config['test']:
+        obs_stats = SharedObsStats(config['state_dim'], num_writers=num_shards)
+    elif config['obs_normalization']:
+        # the tested policy acts on states normalized with the statistics saved along with it
+        obs_stats = FixedObsStats(RunningMeanStd.load(obs_rms_path(path_model)))
+    batch_slots = None
+    if config['batch_slots'] and not config['test']:
+        # every queued message holds a slot, so the batch queue can never be the one that is full
+        assert config['batch_slots'] <= config['batch_queue_size'], "More batch slots than batch queue entries"
+        batch_slots = SharedBatchSlots(config['batch_slots'], config['batch_size'], config['state_dim'],
+                                       config['action_dim'], batches_per_slot=config['batches_per_message'],
+                                       wakeup=sampler_wakeups[0])
 
     # Logger
     p = torch_mp.Process(target=logger, args=(config, logs, training_on, update_step, global_episode, global_step,
-                                              experiment_dir if not config['test'] else results_dir))
+                                              experiment_dir if not config['test'] else results_dir, ratio_controller))
     processes.append(p)
 
     # Data sampler
-    if not config['test']:
-        batch_queue = mp.Queue(maxsize=config['batch_queue_size'])
-        p = torch_mp.Process(target=sampler_worker, args=(config, replay_queue, batch_queue, replay_priorities_queue,
-                                                          training_on, global_episode, logs, experiment_dir))
-        processes.append(p)
+    batch_queue = None
+    if not config['test'] and not learner_resident:
+        batch_queues = [NotifyingQueue(mp.Queue(maxsize=config['batch_queue_size']), wakeup, notify='get')
+                        for wakeup in sampler_wakeups]
+        for shard in range(num_shards):
+            p = torch_mp.Process(target=sampler_worker, args=(config, replay_queues[shard], batch_queues[shard],
+                                                              priorities_queues[shard], training_on, global_episode,
+                                                              logs, experiment_dir, replay_storage, batch_slots, shard,
+                                                              num_shards, obs_stats, sampler_wakeups[shard]))
+            processes.append(p)
+        # the learner sees a single batch queue, sub-batches are merged with global importance weights
+        batch_queue = batch_queues[0]
+        if num_shards > 1:
+            batch_queue = ShardedBatchQueue(batch_queues, config['batches_per_message'])
+            replay_priorities_queue = ShardedPriorityQueue(priorities_queues)
 
     # Learner (neural net training process)
     assert any(config['model'] == np.array(['PDDRL', 'PDSRL']))  # Only D4PG and DSAC
@@ -255,23 +421,37 @@ if __name__ == "__main__":
         target_policy_net.share_memory()
 
     print('Algorithm:', config['model'], "-" + 'P' if config['replay_memory_prioritized'] else 'N')
+    policy_weights, target_weights, exploitation_policy = None, None, target_policy_net
     if not config['test']:
+        # the learner publishes its policy here, every exploration agent picks up each new version
+        policy_weights = SharedPolicyWeights(sum(p.numel() for p in policy_net.parameters()))
+        policy_weights.publish(policy_net)
+        # the exploitation agent acts with its own copy of the target policy, refreshed from complete snapshots
+        # instead of reading the tensors the learner updates in place
+        target_weights = SharedPolicyWeights(sum(p.numel() for p in target_policy_net.parameters()))
+        target_weights.publish(target_policy_net)
+        exploitation_policy = copy.deepcopy(target_policy_net)
         p = torch_mp.Process(target=learner_worker, args=(config, training_on, policy_net, target_policy_net,
-                                                          learner_w_queue, replay_priorities_queue, batch_queue,
-                                                          update_step, global_episode, logs, experiment_dir))
+                                                          policy_weights, replay_priorities_queue, batch_queue,
+                                                          update_step, global_episode, logs, experiment_dir,
+                                                          batch_slots, ratio_controller, obs_stats, replay_storage,
+                                                          target_weights))
         processes.append(p)
 
     # Single agent for exploitation
-    p = torch_mp.Process(target=agent_worker, args=(config, target_policy_net, None, global_episode, 0, "exploitation",
-                                                    experiment_dir, training_on, replay_queue, logs, global_step))
+    p = torch_mp.Process(target=agent_worker, args=(config, exploitation_policy, target_weights, global_episode, 0,
+                                                    "exploitation", experiment_dir, training_on, replay_queue, logs,
+                                                    global_step, None, obs_stats))
     processes.append(p)
 
     # Agents (exploration processes)
     if not config['test']:
         for i in range(1, config['num_agents']):
-            p = torch_mp.Process(target=agent_worker, args=(config, copy.deepcopy(policy_net_cpu), learner_w_queue,
+            agent_replay = replay_queues[(i - 1) % num_shards] if replay_storage is None else replay_storage
+            p = torch_mp.Process(target=agent_worker, args=(config, copy.deepcopy(policy_net_cpu), policy_weights,
                                                             global_episode, i, "exploration", experiment_dir,
-                                                            training_on, replay_queue, logs, global_step))
+                                                            training_on, agent_replay, logs, global_step,
+                                                            ratio_controller, obs_stats))
             processes.append(p)
 
     for p in processes:
@@ -279,4 +459,17 @@ if __name__ == "__main__":
     for p in processes:
         p.join()
 
+    if replay_storage is not None:
+        replay_storage.unlink()
+    if batch_slots is not None:
+        batch_slots.unlink()
+    if isinstance(obs_stats, SharedObsStats):
+        obs_stats.unlink()
+    if policy_weights is not None:
+        policy_weights.unlink()
+        target_weights.unlink()
+    for priorities_queue in priorities_queues:
+        if isinstance(priorities_queue, SharedPriorityRing):
+            priorities_queue.unlink()
+
     print("End.")
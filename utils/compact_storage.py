@@ -0,0 +1,139 @@
+import numpy as np
+
+STORAGE_DTYPES = ('float32', 'float16', 'int8', 'uint16')
+
+
+class CompactArray(object):
+    """Array kept in reduced precision, encoded on assignment and decoded to float32 when indexed.
+
+    float16 is a plain cast. int8 / uint16 are quantized per feature (last axis) with an offset and a
+    scale fitted to the data written so far. When new data falls outside the fitted range the range is
+    widened with some headroom and the affected features of the rows written so far are re-encoded,
+    which happens a handful of times early in training (while few rows are filled) and then stops.
+
+    Every widening grows the span of a feature by at least `headroom` times its previous span, so the
+    quantization steps of the successive scales grow geometrically. Each re-encoding rounds once more,
+    at most half a step of its scale, and these roundings add up to at most (1 + headroom) / (2 * headroom)
+    steps of the final scale (2.5 with the default headroom), plus the half step of the encoding itself.
+    The same geometric growth bounds the number of widenings, and with it the whole-buffer re-encodes
+    once every row is written, to the logarithm of how far the data outgrows its first range.
+    """
+    def __init__(self, shape, dtype, headroom=0.25):
+        """
+        :param shape: shape of the array, features along the last axis
+        :param dtype: storage dtype, one of float16, int8 or uint16
+        :param headroom: fraction of the range added on the side that grows when the range is widened
+        """
+        self.dtype = np.dtype(dtype)
+        assert self.dtype.name in STORAGE_DTYPES, f"Unsupported storage dtype {dtype}"
+        self.codes = np.zeros(shape, dtype=self.dtype)
+        self.quantized = self.dtype.kind in 'iu'
+        self.headroom = headroom
+        self.low, self.high = None, None
+        self.num_rows = 0  # rows below this one along the first axis may hold data
+        if self.quantized:
+            info = np.iinfo(self.dtype)
+            self._qmin, self._qmax = float(info.min), float(info.max)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def _scale(self, low, high):
+        return np.maximum(high - low, 1e-6) / (self._qmax - self._qmin)
+
+    def _encode(self, value, low, high):
+        if not self.quantized:
+            return value.astype(self.dtype)
+        codes = np.rint((value - low) / self._scale(low, high)) + self._qmin
+        return np.clip(codes, self._qmin, self._qmax).astype(self.dtype)
+
+    def _decode(self, codes, low, high):
+        if not self.quantized:
+            return codes.astype(np.float32)
+        return ((codes.astype(np.float32) - self._qmin) * self._scale(low, high) + low).astype(np.float32)
+
+    def _fit(self, value):
+        """Widen the per feature range to cover `value`, re-encoding the features whose range changed."""
+        flat = value.reshape(-1, self.shape[-1])
+        if len(flat) == 0:
+            return
+        low, high = flat.min(axis=0), flat.max(axis=0)
+        if self.low is None:
+            self.low, self.high = low, high
+            return
+        changed = (low < self.low) | (high > self.high)
+        if not changed.any():
+            return
+        new_low, new_high = np.minimum(self.low, low), np.maximum(self.high, high)
+        span = new_high - new_low
+        new_low = np.where(low < self.low, new_low - self.headroom * span, new_low)
+        new_high = np.where(high > self.high, new_high + self.headroom * span, new_high)
+        # the rows that were never written hold no data, leave them alone
+        live = self.codes[:self.num_rows]
+        old = self._decode(live[..., changed], self.low[changed], self.high[changed])
+        live[..., changed] = self._encode(old, new_low[changed], new_high[changed])
+        self.low, self.high = new_low.astype(np.float32), new_high.astype(np.float32)
+
+    def _grow_rows(self, idx):
+        """Raise `num_rows` past the rows written by an assignment at `idx`."""
+        rows = idx[0] if isinstance(idx, tuple) else idx
+        if isinstance(rows, slice):
+            rows = np.arange(len(self.codes))[rows]
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        if rows.size:
+            self.num_rows = max(self.num_rows, int((rows % len(self.codes)).max()) + 1)
+
+    def __setitem__(self, idx, value):
+        value = np.nan_to_num(np.asarray(value, dtype=np.float32))
+        if self.quantized:
+            self._fit(value)
+            self._grow_rows(idx)
+        self.codes[idx] = self._encode(value, self.low, self.high)
+
+    def __getitem__(self, idx):
+        return self._decode(self.codes[idx], self.low, self.high)
+
+
+def storage_array(shape, dtype='float32'):
+    """Zeroed storage for a replay field, a plain float32 array unless a compact dtype is requested."""
+    if np.dtype(dtype) == np.float32:
+        return np.zeros(shape, dtype=np.float32)
+    return CompactArray(shape, dtype)
+
+
+def storage_columns(storage):
+    """Flatten a dict of (compact) arrays into plain columns for `save_columns`, codes are written as they are."""
+    columns = {}
+    for key, value in storage.items():
+        if isinstance(value, CompactArray):
+            columns[key] = value.codes
+            if value.low is not None:
+                columns[f"{key}_low"], columns[f"{key}_high"] = value.low, value.high
+        else:
+            columns[key] = value
+    return columns
+
+
+def restore_storage(storage, columns):
+    """
+    Inverse of `storage_columns`: point the fields of `storage` at loaded columns.
+    """
+    for key, value in storage.items():
+        if isinstance(value, CompactArray):
+            assert columns[key].dtype == value.dtype, f"Saved field {key} is stored as {columns[key].dtype}"
+            value.codes = columns[key]
+            value.num_rows = len(value.codes)
+            if f"{key}_low" in columns:
+                value.low, value.high = np.array(columns[f"{key}_low"]), np.array(columns[f"{key}_high"])
+        else:
+            storage[key] = columns[key]
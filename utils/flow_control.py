@@ -0,0 +1,84 @@
+import time
+
+
+class ReplayRatioController(object):
+    """Holds the number of learner updates per environment step close to a target.
+
+    Both sides read the `global_step` and `update_step` counters shared by train.py: the learner
+    waits when it runs ahead of `ratio * steps` by more than the tolerance, the exploration agents
+    wait when the learner falls behind by more than the tolerance. The two bands never overlap so
+    one side can always make progress. During the first `warmup` steps the replay memory fills up:
+    the agents are not throttled and the learner waits, its updates count from the end of the warmup.
+    """
+    def __init__(self, ratio, tolerance, warmup, global_step, update_step):
+        """
+        :param ratio: target gradient updates per environment step
+        :param tolerance: allowed relative deviation from the target, at least one update either way
+        :param warmup: environment steps collected before the learner starts updating and the ratio is enforced
+        """
+        self.ratio = ratio
+        self.tolerance = tolerance
+        self.warmup = warmup
+        self.global_step = global_step
+        self.update_step = update_step
+
+    def _bounds(self):
+        expected = self.ratio * max(self.global_step.value - self.warmup, 0)
+        error = max(self.tolerance * expected, 1.0)
+        return expected - error, expected + error
+
+    def achieved_ratio(self):
+        return self.update_step.value / max(self.global_step.value - self.warmup, 1)
+
+    def learner_may_update(self):
+        return self.global_step.value >= self.warmup and self.update_step.value < self._bounds()[1]
+
+    def agent_may_step(self):
+        return self.global_step.value < self.warmup or self.update_step.value >= self._bounds()[0]
+
+    def wait_agent(self, training_on, interval=0.001):
+        """Block an exploration agent until the learner caught up (or training is over)."""
+        while training_on.value and not self.agent_may_step():
+            time.sleep(interval)
+
+
+class NotifyingQueue(object):
+    """Queue that sets an event on every put (or get), so the sampler can sleep until there is work.
+
+    Each sampler shard has one wakeup event: its replay queue sets it when an agent sends transitions
+    and its batch queue when the learner takes a batch, so a single `wait` covers both reasons to run.
+    Only the side the sampler is not on notifies, its own puts and gets never wake it up.
+    """
+    def __init__(self, queue, wakeup, notify='put'):
+        """
+        :param queue: the multiprocessing queue to wrap
+        :param wakeup: multiprocessing event of the sampler
+        :param notify: 'put' for a queue the sampler reads from, 'get' for one it fills
+        """
+        assert notify in ('put', 'get')
+        self._queue = queue
+        self.wakeup = wakeup
+        self._notify = notify
+
+    def put(self, item, block=True, timeout=None):
+        self._queue.put(item, block, timeout)
+        if self._notify == 'put':
+            self.wakeup.set()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        item = self._queue.get(block, timeout)
+        if self._notify == 'get':
+            self.wakeup.set()
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self._queue.close()
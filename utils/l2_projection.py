@@ -2,12 +2,13 @@
 # https://github.com/PacktPublishing/Deep-Reinforcement-Learning-Hands-On/blob/master/Chapter14/06_train_d4pg.py
 
 import numpy as np
+import torch
 
 
 def _l2_project(next_distr_v, rewards_v, dones_mask_t, gamma, delta_z, n_atoms, v_min, v_max):
     next_distr = next_distr_v.data.cpu().numpy()
     rewards = rewards_v.data.cpu().numpy()
-    dones_mask = dones_mask_t.cpu().numpy().astype(np.bool)
+    dones_mask = dones_mask_t.cpu().numpy().astype(bool)
     batch_size = len(rewards)
     proj_distr = np.zeros((batch_size, n_atoms), dtype=np.float32)
 
@@ -40,4 +41,32 @@ def _l2_project(next_distr_v, rewards_v, dones_mask_t, gamma, delta_z, n_atoms,
             proj_distr[ne_dones, l[ne_mask]] = (u - b_j)[ne_mask]
             proj_distr[ne_dones, u[ne_mask]] = (b_j - l)[ne_mask]
 
-    return proj_distr
\ No newline at end of file
+    return proj_distr
+
+
+def l2_project(next_distr, rewards, dones, gamma, delta_z, n_atoms, v_min, v_max):
+    """
+    Same projection as `_l2_project` on tensors, without leaving their device.
+    Every (row, atom) pair is projected at once and its mass split between the two neighbouring atoms
+    with two scatter-adds. Terminal rows put all their mass at the reward instead.
+    :param gamma: discount, a float or a tensor with one value per row (N-step transitions)
+    :return: projected distribution, float32 tensor (batch, n_atoms)
+    """
+    next_distr = next_distr.detach().float()
+    rewards = rewards.reshape(-1, 1).float()
+    dones = dones.reshape(-1, 1) > 0
+    if isinstance(gamma, torch.Tensor):
+        gamma = gamma.reshape(-1, 1).to(next_distr.device, dtype=torch.float32)
+    atoms = v_min + delta_z * torch.arange(n_atoms, device=next_distr.device, dtype=torch.float32)
+    tz = torch.clamp(rewards + torch.where(dones, torch.zeros_like(atoms), atoms * gamma), v_min, v_max)
+    # a terminal row spreads a total mass of 1 over atoms that all land on the reward
+    next_distr = torch.where(dones, torch.full_like(next_distr, 1.0 / n_atoms), next_distr)
+    b = (tz - v_min) / delta_z
+    l, u = b.floor(), b.ceil()
+    # an atom landing exactly on a support point keeps its whole mass there
+    mass_l = next_distr * (u - b + (u == l).float())
+    mass_u = next_distr * (b - l)
+    proj_distr = torch.zeros_like(next_distr)
+    proj_distr.scatter_add_(1, l.long().clamp(0, n_atoms - 1), mass_l)
+    proj_distr.scatter_add_(1, u.long().clamp(0, n_atoms - 1), mass_u)
+    return proj_distr
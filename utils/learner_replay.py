@@ -0,0 +1,94 @@
+from utils.running_stats import RunningMeanStd
+import numpy as np
+import queue
+import torch
+
+
+class LearnerReplayBuffer(object):
+    """Uniform replay memory living in the learner process, in place of the sampler and its batch queue.
+
+    The agents write their transitions into a SharedReplayStorage, every `get_nowait` of the learner
+    picks up the newly committed ones and samples a batch with torch indexing. On the CPU the fields
+    are tensors over the shared memory itself, on a GPU they are preallocated on the device and only
+    the new transitions are copied over, so sampled batches never leave the device. Reading the shared
+    memory directly, the CPU path leaves out the oldest slots the agents are already rewriting.
+    """
+    fields = ('obs', 'action', 'reward', 'next_obs', 'done', 'gamma')
+
+    def __init__(self, shared_storage, batch_size, device='cpu', obs_stats=None):
+        """
+        :param shared_storage: SharedReplayStorage the agents write into
+        :param batch_size: transitions per sampled batch, nothing is sampled before the buffer holds that many
+        :param obs_stats: SharedObsStats to publish the running state statistics to (the learner is its only writer)
+        """
+        self._shared = shared_storage
+        self._maxsize = len(shared_storage)
+        self._batch_size = batch_size
+        self._device = torch.device(device)
+        self._next_idx = 0
+        self._size = 0
+        self._num_added = 0
+        source = shared_storage.storage
+        if self._device.type == 'cpu':
+            self._storage = {key: torch.from_numpy(source[key]) for key in self.fields}
+        else:
+            self._storage = {key: torch.zeros(source[key].shape, dtype=torch.float32, device=self._device)
+                             for key in self.fields}
+        self._obs_stats = obs_stats
+        self._obs_rms = None
+        if obs_stats is not None:
+            self._obs_rms = RunningMeanStd(source['obs'].shape[1])
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def num_added(self):
+        return self._num_added
+
+    def sync(self):
+        """Take over the transitions the agents committed since the last call, returns how many."""
+        num_new = self._shared.poll()
+        if num_new == 0:
+            return 0
+        num_kept = min(num_new, self._maxsize)
+        slots = (self._next_idx + num_new - num_kept + np.arange(num_kept)) % self._maxsize
+        if self._device.type != 'cpu':
+            slots_t = torch.from_numpy(slots).to(self._device)
+            for key in self.fields:
+                self._storage[key][slots_t] = torch.from_numpy(self._shared.storage[key][slots]).to(self._device)
+        if self._obs_rms is not None:
+            self._obs_rms.update(self._shared.storage['obs'][slots])
+            self._obs_stats.publish(0, self._obs_rms)
+        self._next_idx = (self._next_idx + num_new) % self._maxsize
+        self._size = min(self._size + num_new, self._maxsize)
+        self._num_added += num_new
+        return num_new
+
+    def sample(self, batch_size):
+        """Batch in the usual layout, every field a tensor on the learner device.
+        Raises queue.Empty when the agents are rewriting every stored slot.
+        """
+        num_in_flight = 0
+        if self._device.type == 'cpu':
+            # same window as ArrayReplayBuffer._num_in_flight, the device copies only ever hold committed rows
+            num_in_flight = min(max(self._shared.num_in_flight() - (self._maxsize - self._size), 0), self._size)
+            if num_in_flight == self._size:
+                raise queue.Empty  # every stored slot is being rewritten by the agents
+        positions = torch.randint(num_in_flight, self._size, (batch_size,), device=self._device)
+        idxes = (self._next_idx - self._size + positions) % self._maxsize
+        weights = torch.zeros(batch_size, device=self._device)
+        return [self._storage[key][idxes] for key in self.fields] + [weights, idxes]
+
+    def get_nowait(self):
+        """Same call as on the batch queue: a fresh batch, queue.Empty while the memory is still filling up."""
+        self.sync()
+        if self._size < self._batch_size:
+            raise queue.Empty
+        return self.sample(self._batch_size)
+
+    def qsize(self):
+        return 0
+
+    def close(self):
+        pass
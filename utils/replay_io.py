@@ -0,0 +1,161 @@
+import numpy as np
+import threading
+import shutil
+import queue
+import json
+import os
+
+META_FILE = "meta.json"
+
+
+def save_columns(save_dir, columns, meta):
+    """
+    Write a replay buffer in columnar format: one .npy file per field plus a small json header.
+    The directory is written next to the old one and swapped in at the end, so a buffer that is
+    still memory mapped from `save_dir` keeps reading its (unlinked) files.
+    :param save_dir: destination directory
+    :param columns: dict of field name -> array
+    :param meta: json serializable metadata (ring pointers, max priority, ...)
+    """
+    tmp_dir = save_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for key, value in columns.items():
+        np.save(os.path.join(tmp_dir, f"{key}.npy"), value)
+    # the header is written last, a directory without it is an interrupted dump
+    with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+        json.dump(dict(meta, columns=sorted(columns)), f)
+
+    old_dir = save_dir.rstrip("/") + ".old"
+    if os.path.exists(save_dir):
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(save_dir, old_dir)
+    os.rename(tmp_dir, save_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def load_columns(save_dir, mmap_mode="c"):
+    """
+    Open a replay buffer written by `save_columns`.
+    :param mmap_mode: np.load memory map mode, the default copy-on-write mode pages the data in lazily
+        and never writes back to the files
+    :return: (dict of field name -> memmap, metadata)
+    """
+    with open(os.path.join(save_dir, META_FILE)) as f:
+        meta = json.load(f)
+    columns = {key: np.load(os.path.join(save_dir, f"{key}.npy"), mmap_mode=mmap_mode) for key in meta["columns"]}
+    return columns, meta
+
+
+def has_columns(save_dir):
+    return os.path.exists(os.path.join(save_dir, META_FILE))
+
+
+class ReplaySnapshotWriter(object):
+    """
+    Append-only snapshots of a replay buffer taken while training.
+    Every flush writes only the transitions inserted since the previous one as a new numbered segment,
+    the writes happen on a background thread so the sampler loop never waits on the disk. Segments
+    that newer ones already replace in a buffer of `capacity` transitions are deleted, so the
+    directory holds about `capacity` transitions (plus at most one segment).
+    """
+    def __init__(self, segment_dir, replay_buffer, capacity):
+        """
+        :param segment_dir: directory of the segments, numbering continues after the ones already there
+        :param replay_buffer: buffer to snapshot, what it already holds (e.g. resumed data) is not written again
+        :param capacity: number of transitions the replay buffer keeps
+        """
+        self._segment_dir = segment_dir
+        self._capacity = capacity
+        os.makedirs(segment_dir, exist_ok=True)
+        files = _segment_files(segment_dir)
+        self._next_segment = _segment_number(files[-1]) + 1 if files else 0
+        self._flushed = replay_buffer.num_added
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            path, columns = item
+            # write under a temporary name so a half written segment is never picked up on resume
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, **columns)
+            os.rename(path + ".tmp", path)
+            for file in _expired_segments(self._segment_dir, self._capacity):
+                os.remove(os.path.join(self._segment_dir, file))
+
+    def maybe_flush(self, replay_buffer, every):
+        """Queue a new segment once `every` transitions were inserted since the last one."""
+        num_new = replay_buffer.num_added - self._flushed
+        if num_new < every:
+            return
+        columns = replay_buffer.get_recent(num_new)
+        # transitions the ring already overwrote are lost, only what is still stored gets written
+        self._flushed = replay_buffer.num_added
+        # the file name carries the number of transitions so pruning never has to open a segment
+        path = os.path.join(self._segment_dir, f"segment_{self._next_segment:06d}_{len(columns['reward'])}.npz")
+        self._next_segment += 1
+        self._queue.put((path, columns))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _segment_files(segment_dir):
+    """Segment file names, oldest first."""
+    if not os.path.isdir(segment_dir):
+        return []
+    return sorted(f for f in os.listdir(segment_dir) if f.startswith("segment_") and f.endswith(".npz"))
+
+
+def _segment_number(file):
+    return int(file[:-len(".npz")].split("_")[1])
+
+
+def _segment_size(segment_dir, file):
+    """Number of transitions in a segment, read from the file name or from the segment itself."""
+    parts = file[:-len(".npz")].split("_")
+    if len(parts) == 3:
+        return int(parts[2])
+    with np.load(os.path.join(segment_dir, file)) as segment:
+        return len(segment["reward"])
+
+
+def _expired_segments(segment_dir, capacity):
+    """Oldest segments whose transitions would all be overwritten by the newer ones in a buffer of `capacity`."""
+    files = _segment_files(segment_dir)
+    num_newer = 0
+    for i in range(len(files) - 1, -1, -1):
+        if num_newer >= capacity:
+            return files[:i + 1]
+        num_newer += _segment_size(segment_dir, files[i])
+    return []
+
+
+def load_segments(segment_dir, replay_buffer, capacity=None):
+    """
+    Replay the segments written by `ReplaySnapshotWriter` into `replay_buffer`, oldest first.
+    :param capacity: number of transitions the buffer keeps, segments it would overwrite anyway are skipped
+    :return: number of transitions inserted
+    """
+    files = _segment_files(segment_dir)
+    if capacity is not None:
+        files = files[len(_expired_segments(segment_dir, capacity)):]
+    num_loaded = 0
+    for file in files:
+        with np.load(os.path.join(segment_dir, file)) as segment:
+            columns = {key: segment[key] for key in segment.files}
+        episode_end = columns.pop("episode_end", None)
+        if episode_end is None:
+            bounds = [0, len(columns["reward"])]
+        else:
+            bounds = [0] + list(np.flatnonzero(episode_end) + 1)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            replay_buffer.add_episode(**{key: value[start:end] for key, value in columns.items()})
+        num_loaded += len(columns["reward"])
+    return num_loaded
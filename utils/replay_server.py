@@ -0,0 +1,263 @@
+"""
+Replay memory served over a socket, so several training runs or external collectors can share one buffer.
+Start it with `python -m utils.replay_server [address]` and point `replay_server` in config.yml at it.
+
+The server does no authentication at all: anyone who can connect can read the whole buffer and write
+into it. It listens on 127.0.0.1 unless told otherwise, only bind it to another interface on a trusted
+network (or reach it through an SSH tunnel).
+
+Every request and reply is a frame: a 9 byte header (operation or status code, payload length) followed
+by a payload of named numpy arrays, each one written as its name, dtype, shape and raw bytes. There is
+no pickling, any client that writes the same layout can talk to the server.
+"""
+from utils.utils import create_replay_buffer, flatten_obs, stack_transitions
+import socketserver
+import numpy as np
+import threading
+import argparse
+import socket
+import struct
+import yaml
+import os
+
+OP_INSERT = 1
+OP_SAMPLE = 2
+OP_UPDATE_PRIORITIES = 3
+OP_STATS = 4
+STATUS_OK = 0
+STATUS_ERROR = 255
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_ADDRESS = f'{DEFAULT_HOST}:7878'
+
+BATCH_FIELDS = ('obs', 'action', 'reward', 'next_obs', 'done', 'gamma', 'weights', 'idxes')
+_FRAME = struct.Struct('<BQ')
+_ARRAY = struct.Struct('<HHB')
+
+
+def pack_arrays(arrays):
+    """Serialize a dict of name -> array into a payload."""
+    parts = []
+    for name, value in arrays.items():
+        value = np.asarray(value)
+        name, dtype = name.encode(), value.dtype.str.encode()
+        parts += [_ARRAY.pack(len(name), len(dtype), value.ndim), name, dtype,
+                  struct.pack(f'<{value.ndim}q', *value.shape), value.tobytes()]
+    return b''.join(parts)
+
+
+def unpack_arrays(payload):
+    """Inverse of `pack_arrays`, the arrays are writable views of the payload (a bytearray)."""
+    arrays, offset = {}, 0
+    view = memoryview(payload)
+    while offset < len(payload):
+        name_len, dtype_len, ndim = _ARRAY.unpack_from(payload, offset)
+        offset += _ARRAY.size
+        name = bytes(view[offset:offset + name_len]).decode()
+        offset += name_len
+        dtype = np.dtype(bytes(view[offset:offset + dtype_len]).decode())
+        offset += dtype_len
+        shape = struct.unpack_from(f'<{ndim}q', payload, offset)
+        offset += 8 * ndim
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        arrays[name] = np.frombuffer(view[offset:offset + nbytes], dtype=dtype).reshape(shape)
+        offset += nbytes
+    return arrays
+
+
+def _recv_exact(sock, num_bytes):
+    buffer = bytearray(num_bytes)
+    view, received = memoryview(buffer), 0
+    while received < num_bytes:
+        chunk = sock.recv_into(view[received:])
+        if chunk == 0:
+            raise ConnectionError("Replay socket closed")
+        received += chunk
+    return buffer
+
+
+def send_frame(sock, code, arrays=None):
+    payload = pack_arrays(arrays or {})
+    sock.sendall(_FRAME.pack(code, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    code, length = _FRAME.unpack(_recv_exact(sock, _FRAME.size))
+    return code, unpack_arrays(_recv_exact(sock, length))
+
+
+def parse_address(address):
+    """`host:port` is a TCP address (`:port` on localhost), anything else is the path of a Unix socket."""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or DEFAULT_HOST, int(port))
+    return socket.AF_UNIX, address
+
+
+class _ReplayRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                code, arrays = recv_frame(self.request)
+            except ConnectionError:
+                return
+            try:
+                reply = self.server.dispatch(code, arrays)
+            except Exception as e:
+                send_frame(self.request, STATUS_ERROR, {'error': np.frombuffer(repr(e).encode(), dtype=np.uint8)})
+            else:
+                send_frame(self.request, STATUS_OK, reply)
+
+
+class ReplayServer(object):
+    """Serves one of the replay buffers of utils.utils to any number of clients, one thread per connection.
+
+    Requests are applied to the buffer one at a time. Inserted columns hold consecutive transitions,
+    with an optional `episode_end` column to send several episodes at once (same layout as the
+    snapshot segments), and the buffer is trimmed to `max_size` after each insert like in the sampler.
+    """
+    def __init__(self, replay_buffer, address, max_size=None):
+        """
+        :param address: `host:port` to listen on TCP, otherwise the path of a Unix socket. The clients are not
+        authenticated, keep TCP servers on localhost or a trusted network
+        :param max_size: capacity enforced with `remove` for the list based buffers, None to leave it to the buffer
+        """
+        self.replay_buffer = replay_buffer
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        family, self.address = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            server_class = socketserver.ThreadingUnixStreamServer
+        else:
+            server_class = socketserver.ThreadingTCPServer
+        self._server = server_class(self.address, _ReplayRequestHandler, bind_and_activate=False)
+        self._server.allow_reuse_address = True
+        self._server.server_bind()
+        self._server.server_activate()
+        self._server.daemon_threads = True
+        self._server.dispatch = self.dispatch
+        self.address = self._server.server_address
+        self._thread = None
+
+    def dispatch(self, code, arrays):
+        with self._lock:
+            if code == OP_INSERT:
+                self._insert(arrays)
+                return self._stats()
+            if code == OP_SAMPLE:
+                kwargs = {'beta': float(arrays['beta'])}
+                if 'n_step' in arrays:
+                    kwargs['n_step'] = int(arrays['n_step'])
+                batch = self.replay_buffer.sample(int(arrays['batch_size']), **kwargs)
+                return {key: flatten_obs(value) if key in ('obs', 'next_obs') else np.asarray(value)
+                        for key, value in zip(BATCH_FIELDS, batch)}
+            if code == OP_UPDATE_PRIORITIES:
+                self.replay_buffer.update_priorities(arrays['idxes'], arrays['priorities'])
+                return {}
+            if code == OP_STATS:
+                return self._stats()
+        raise ValueError(f"Unknown replay server operation {code}")
+
+    def _insert(self, columns):
+        episode_end = columns.pop('episode_end', None)
+        if episode_end is None:
+            bounds = [0, len(columns['reward'])]
+        else:
+            bounds = [0] + list(np.flatnonzero(episode_end) + 1)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            self.replay_buffer.add_batch({key: value[start:end] for key, value in columns.items()})
+        if self.max_size is not None and len(self.replay_buffer) > self.max_size:
+            self.replay_buffer.remove(len(self.replay_buffer) - self.max_size)
+
+    def _stats(self):
+        return {'size': np.int64(len(self.replay_buffer)), 'num_added': np.int64(self.replay_buffer.num_added)}
+
+    def start(self):
+        """Serve from a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class ReplayClient(object):
+    """Connection to a ReplayServer with the interface the sampler expects from a replay buffer."""
+    def __init__(self, address):
+        family, address = parse_address(address)
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.connect(address)
+        if family == socket.AF_INET:
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _call(self, code, arrays=None):
+        send_frame(self._sock, code, arrays)
+        status, reply = recv_frame(self._sock)
+        if status != STATUS_OK:
+            raise RuntimeError(f"Replay server error: {bytes(reply['error']).decode()}")
+        return reply
+
+    def insert(self, columns):
+        """Insert a dict of columns of consecutive transitions (optionally with `episode_end`), returns `stats()`."""
+        reply = self._call(OP_INSERT, columns)
+        return {key: int(value) for key, value in reply.items()}
+
+    def add_batch(self, batch):
+        self.insert({key: batch[key] for key in ('obs', 'action', 'reward', 'next_obs', 'done', 'gamma')})
+
+    def add(self, obs_t, action, reward, obs_tp1, done, gamma):
+        self.add_batch(stack_transitions([(obs_t, action, reward, obs_tp1, done, gamma)]))
+
+    def sample(self, batch_size, beta=0.6, n_step=None, **kwargs):
+        request = {'batch_size': np.int64(batch_size), 'beta': np.float64(beta)}
+        if n_step is not None:
+            request['n_step'] = np.int64(n_step)
+        reply = self._call(OP_SAMPLE, request)
+        return [reply[key] for key in BATCH_FIELDS]
+
+    def update_priorities(self, idxes, priorities):
+        self._call(OP_UPDATE_PRIORITIES, {'idxes': np.asarray(idxes, dtype=np.int64).flatten(),
+                                          'priorities': np.asarray(priorities, dtype=np.float64).flatten()})
+
+    def stats(self):
+        return {key: int(value) for key, value in self._call(OP_STATS).items()}
+
+    def __len__(self):
+        return self.stats()['size']
+
+    @property
+    def num_added(self):
+        return self.stats()['num_added']
+
+    def remove(self, num_samples):
+        pass  # the server keeps its buffer to size
+
+    def close(self):
+        self._sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a replay buffer built from config.yml over a socket")
+    parser.add_argument('address', nargs='?', default=DEFAULT_ADDRESS,
+                        help="host:port for TCP, otherwise the path of a Unix socket. There is no authentication, "
+                             "only listen on other interfaces than localhost on a trusted network")
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                         'config.yml'))
+    args = parser.parse_args()
+    with open(args.config, 'r') as ymlfile:
+        config = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    server = ReplayServer(create_replay_buffer(config, None), args.address, max_size=config['replay_mem_size'])
+    print(f"Serving replay buffer on {server.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
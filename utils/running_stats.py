@@ -0,0 +1,76 @@
+import numpy as np
+import torch
+import os
+
+
+def merge_moments(mean_a, var_a, count_a, mean_b, var_b, count_b):
+    """
+    Combine the mean / variance of two disjoint sets of samples (Chan et al. parallel Welford update).
+    :return: (mean, var, count) of the union
+    """
+    count = count_a + count_b
+    if count == 0:
+        return mean_a, var_a, count
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = var_a * count_a + var_b * count_b + delta ** 2 * (count_a * count_b / count)
+    return mean, m2 / count, count
+
+
+class RunningMeanStd(object):
+    """Per feature running mean and variance of the flat states, updated a batch at a time."""
+    def __init__(self, shape, mean=None, var=None, count=0.0):
+        self.mean = np.zeros(shape, dtype=np.float64) if mean is None else mean
+        self.var = np.ones(shape, dtype=np.float64) if var is None else var
+        self.count = count
+
+    def update(self, x):
+        """Fold a batch of states (batch, *shape) into the statistics."""
+        x = np.asarray(x, dtype=np.float64).reshape((-1,) + self.mean.shape)
+        if len(x) == 0:
+            return
+        self.merge(x.mean(axis=0), x.var(axis=0), len(x))
+
+    def merge(self, mean, var, count):
+        """Fold the statistics of another set of states into these ones."""
+        if self.count == 0:
+            # the initial unit variance is a placeholder, not data
+            self.mean, self.var, self.count = np.array(mean, dtype=np.float64), np.array(var, dtype=np.float64), count
+            return
+        self.mean, self.var, self.count = merge_moments(self.mean, self.var, self.count, mean, var, count)
+
+    def normalize(self, x, clip=10.0, epsilon=1e-8):
+        """Standardized float32 copy of `x` (array or tensor), same formula as HerReplayBuffer._normalize_obs."""
+        if isinstance(x, torch.Tensor):
+            if self.count == 0:
+                return x.float()
+            mean = torch.as_tensor(self.mean, dtype=torch.float32, device=x.device)
+            std = torch.as_tensor(np.sqrt(self.var + epsilon), dtype=torch.float32, device=x.device)
+            return torch.clamp((x - mean) / std, -clip, clip)
+        if self.count == 0:
+            return np.asarray(x, dtype=np.float32)
+        std = np.sqrt(self.var + epsilon)
+        return np.clip((np.asarray(x) - self.mean) / std, -clip, clip).astype(np.float32)
+
+    def save(self, path):
+        """Write the moments next to a checkpoint, a policy trained on normalized states needs them to act."""
+        np.savez(path, mean=self.mean, var=self.var, count=self.count)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as moments:
+            return cls(moments['mean'].shape, mean=moments['mean'], var=moments['var'], count=float(moments['count']))
+
+
+def obs_rms_path(model_fn):
+    """File the state statistics of the checkpoint `model_fn` are saved to."""
+    return os.path.splitext(model_fn)[0] + "_obs_rms.npz"
+
+
+class FixedObsStats(object):
+    """Same `get` as SharedObsStats for statistics that no longer change, e.g. loaded with a checkpoint to test it."""
+    def __init__(self, rms):
+        self._rms = rms
+
+    def get(self):
+        return self._rms
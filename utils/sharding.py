@@ -0,0 +1,95 @@
+import numpy as np
+import queue
+
+
+def shard_sizes(batch_size, num_shards):
+    """Sub-batch size served by every shard, they add up to `batch_size`."""
+    return [batch_size // num_shards + (shard < batch_size % num_shards) for shard in range(num_shards)]
+
+
+def shard_batch(batch, shard, num_shards, min_probability=None, beta=None):
+    """
+    Turn a batch sampled from one shard into a sub-batch for `merge_shard_batches` (sampler side).
+    The indexes are interleaved (local * num_shards + shard) so the priority updates find their way back.
+    :param min_probability: smallest sampling probability in the shard, None without prioritized replay
+    :param beta: importance sampling exponent the shard weights were computed with
+    """
+    batch = list(batch)
+    batch[7] = np.asarray(batch[7], dtype=np.int64) * num_shards + shard
+    return batch + [min_probability, beta]
+
+
+def merge_shard_batches(parts, batches_per_message=1):
+    """
+    Concatenate one sub-batch per shard into a batch with the usual layout (learner side), along the
+    batch axis of every minibatch for super-batches.
+
+    A transition of shard k is drawn with probability P_k(j) / num_shards, so its global importance weight
+    is (P_k(j) / P_min)^-beta with P_min the smallest probability over all shards. The shard already
+    normalized by its own minimum, (P_k(j) / P_min_k)^-beta, which only leaves the (P_min / P_min_k)^beta
+    factor; the shard sizes cancel out.
+    """
+    axis = 0 if batches_per_message == 1 else 1
+    batch = [np.concatenate([np.asarray(part[field]) for part in parts], axis=axis) for field in range(8)]
+    min_probabilities = [part[8] for part in parts]
+    if all(p is not None for p in min_probabilities):
+        global_min = min(min_probabilities)
+        batch[6] = np.concatenate([np.asarray(part[6]) * (global_min / part[8]) ** part[9] for part in parts],
+                                  axis=axis)
+    return batch
+
+
+class ShardedBatchQueue(object):
+    """Batch queue over the per-shard queues, every batch holds one sub-batch of each shard."""
+    def __init__(self, queues, batches_per_message=1):
+        self.queues = queues
+        self.batches_per_message = batches_per_message
+        self._pending = [None] * len(queues)
+
+    def get_nowait(self):
+        for shard, q in enumerate(self.queues):
+            if self._pending[shard] is None:
+                # raises queue.Empty, the sub-batches already taken are kept for the next call
+                self._pending[shard] = q.get_nowait()
+        parts, self._pending = self._pending, [None] * len(self.queues)
+        return merge_shard_batches(parts, self.batches_per_message)
+
+    def qsize(self):
+        return min(q.qsize() for q in self.queues)
+
+    def close(self):
+        for q in self.queues:
+            q.close()
+
+
+class ShardedPriorityQueue(object):
+    """Priority queue that routes every updated index back to the shard it was sampled from."""
+    def __init__(self, queues):
+        self.queues = queues
+
+    def put(self, item, *args, **kwargs):
+        inds, priorities = item
+        inds, priorities = np.asarray(inds).flatten(), np.asarray(priorities).flatten()
+        num_shards = len(self.queues)
+        for shard, q in enumerate(self.queues):
+            mask = inds % num_shards == shard
+            if mask.any():
+                q.put((inds[mask] // num_shards, priorities[mask]), *args, **kwargs)
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get_nowait(self):
+        """Next pending update of any shard, with its indexes mapped back to the global ones (used to empty the queues)."""
+        num_shards = len(self.queues)
+        for shard, q in enumerate(self.queues):
+            try:
+                inds, priorities = q.get_nowait()
+            except queue.Empty:
+                continue
+            return np.asarray(inds) * num_shards + shard, priorities
+        raise queue.Empty
+
+    def close(self):
+        for q in self.queues:
+            q.close()
@@ -0,0 +1,445 @@
+from multiprocessing import shared_memory
+from utils.running_stats import RunningMeanStd
+from utils.utils import flatten_obs
+import multiprocessing as mp
+import numpy as np
+import queue
+import torch
+
+
+def _attach(name):
+    # Only the creating process should track (and unlink) the block
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedArrays(object):
+    """Named numpy arrays carved out of a single shared memory block.
+    Pickling only sends the block name and the layout, the receiving process attaches to the same memory.
+    """
+    def __init__(self, spec, name=None):
+        """
+        :param spec: list of (key, shape, dtype) describing the arrays
+        :param name: name of an existing block to attach to, a new block is created when None
+        """
+        self._spec = [(key, tuple(shape), np.dtype(dtype).str) for key, shape, dtype in spec]
+        offsets, nbytes = [], 0
+        for key, shape, dtype in self._spec:
+            nbytes = (nbytes + 63) // 64 * 64  # cache line aligned fields
+            offsets.append(nbytes)
+            nbytes += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        else:
+            self._shm = _attach(name)
+        self.arrays = {key: np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)
+                       for (key, shape, dtype), offset in zip(self._spec, offsets)}
+        if self._owner:
+            for array in self.arrays.values():
+                array.fill(0)
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __getstate__(self):
+        return {'spec': self._spec, 'name': self._shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['spec'], name=state['name'])
+
+    def close(self):
+        self.arrays = {}
+        try:
+            self._shm.close()
+        except BufferError:
+            pass  # views are still alive somewhere in this process, the mapping goes away with it
+
+    def unlink(self):
+        if self._owner:
+            self._shm.unlink()
+
+
+class SharedReplayStorage(object):
+    """Ring of transitions in shared memory, written in place by the agent processes.
+
+    Writers reserve slots from a shared cursor, fill them and then publish the slot with its sequence
+    number. The reader (sampler) only advances over slots whose sequence number is committed, so a
+    transition is never handed out half written. The commits are written under the cursor lock, which
+    doubles as the memory barrier that makes the data visible before its commit (SharedPriorityRing
+    relies on the same). Slots are overwritten once the writers lap the ring, the slots reserved past
+    the read position are the oldest ones of the reader's window and must be left out when sampling
+    (see `num_in_flight`).
+
+    A writer reserves a single slot per `write` and commits it before it can reserve the next one, so
+    it never holds more than one reserved slot. A headroom of one slot per writer therefore covers
+    every reservation made while the reader gathers a batch.
+    """
+    fields = ('obs', 'action', 'reward', 'next_obs', 'done', 'gamma')
+
+    def __init__(self, size, state_dim, action_dim, headroom=0, wakeup=None):
+        """
+        :param headroom: extra slots counted as in flight, for the writes reserved while a batch is being gathered,
+        the number of writers
+        :param wakeup: multiprocessing event set after every commit, the sampler sleeps on it
+        """
+        self._size = size
+        self._headroom = headroom
+        self._wakeup = wakeup
+        self._arrays = SharedArrays([
+            ('obs', (size, state_dim), np.float32),
+            ('action', (size, action_dim), np.float32),
+            ('reward', (size,), np.float32),
+            ('next_obs', (size, state_dim), np.float32),
+            ('done', (size,), np.float32),
+            ('gamma', (size,), np.float32),
+            ('commit', (size,), np.int64),
+        ])
+        self._cursor = mp.Value('q', 0)
+        self._read_seq = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_read_seq'] = 0
+        return state
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def storage(self):
+        """Field arrays in the layout of ArrayReplayBuffer._storage."""
+        return {key: self._arrays[key] for key in self.fields}
+
+    def _reserve(self):
+        # one slot at a time, the headroom assumes it (see the class docstring)
+        with self._cursor.get_lock():
+            seq = self._cursor.value
+            self._cursor.value += 1
+        return seq
+
+    def write(self, obs_t, action, reward, obs_tp1, done, gamma):
+        """Write one transition straight into the shared ring (agent side)."""
+        seq = self._reserve()
+        slot = seq % self._size
+        self._arrays['obs'][slot] = flatten_obs(obs_t)
+        self._arrays['action'][slot] = action
+        self._arrays['reward'][slot] = reward
+        self._arrays['next_obs'][slot] = flatten_obs(obs_tp1)
+        self._arrays['done'][slot] = done
+        self._arrays['gamma'][slot] = gamma
+        with self._cursor.get_lock():
+            self._arrays['commit'][slot] = seq + 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def poll(self):
+        """Advance over the newly committed transitions (sampler side).
+        :return: number of new transitions, the newest ones end right before slot `read_seq % size`
+        """
+        with self._cursor.get_lock():
+            cursor = self._cursor.value
+            start = max(self._read_seq, cursor - self._size)  # skip what the writers already lapped
+            seqs = np.arange(start, cursor)
+            committed = self._arrays['commit'][seqs % self._size] == seqs + 1
+        # stop at the first slot that is reserved but still being written
+        num_ready = len(seqs) if committed.all() else int(np.argmin(committed))
+        num_new = start + num_ready - self._read_seq
+        self._read_seq += num_new
+        return num_new
+
+    def num_in_flight(self):
+        """Slots the writers reserved past the last `poll` (plus the headroom), they may be written at any time.
+        Once the ring has wrapped these are the oldest slots of the reader's window.
+        """
+        return self._cursor.value - self._read_seq + self._headroom
+
+    def close(self):
+        self._arrays.close()
+
+    def unlink(self):
+        self._arrays.unlink()
+
+
+class SharedBatchSlots(object):
+    """Ring of preallocated batches in shared memory between the sampler and the learner.
+
+    The sampler fills a free slot in place and only sends `(slot, seq)` through the batch queue, the
+    learner reads the slot as float32 arrays that `torch.from_numpy` wraps without copying and hands
+    the slot back once its update step is done. A slot can hold a super-batch of several minibatches.
+    """
+    fields = ('obs', 'action', 'reward', 'next_obs', 'done', 'gamma', 'weights', 'idxes')
+
+    def __init__(self, num_slots, batch_size, state_dim, action_dim, batches_per_slot=1, wakeup=None):
+        """
+        :param wakeup: multiprocessing event of the sampler, set whenever the learner releases a slot
+        """
+        # super-batches get a leading minibatch axis, see stack_batches
+        batch = (num_slots, batches_per_slot, batch_size) if batches_per_slot > 1 else (num_slots, batch_size)
+        self._arrays = SharedArrays([
+            ('obs', batch + (state_dim,), np.float32),
+            ('action', batch + (action_dim,), np.float32),
+            ('reward', batch, np.float32),
+            ('next_obs', batch + (state_dim,), np.float32),
+            ('done', batch, np.float32),
+            ('gamma', batch, np.float32),
+            ('weights', batch, np.float32),
+            ('idxes', batch, np.int64),
+            ('seq', (num_slots,), np.int64),
+        ])
+        self._free = mp.Queue(maxsize=num_slots)
+        for slot in range(num_slots):
+            self._free.put(slot)
+        self._seq = 0
+        self._wakeup = wakeup
+
+    def write(self, batch):
+        """Copy a sampled batch into a free slot (sampler side).
+        :return: (slot, seq) to send to the learner, None when every slot is still in use
+        """
+        try:
+            slot = self._free.get_nowait()
+        except queue.Empty:
+            return None
+        for key, value in zip(self.fields, batch):
+            self._arrays[key][slot] = flatten_obs(value) if key in ('obs', 'next_obs') else value
+        self._seq += 1
+        self._arrays['seq'][slot] = self._seq
+        return slot, self._seq
+
+    def read(self, slot, seq):
+        """Batch stored in `slot`, as views of the shared memory (learner side)."""
+        assert self._arrays['seq'][slot] == seq, "Batch slot was overwritten before it was released"
+        return [self._arrays[key][slot] for key in self.fields]
+
+    def release(self, slot):
+        """Give the slot back to the sampler, the arrays returned by `read` must not be used afterwards."""
+        self._free.put(slot)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def close(self):
+        self._arrays.close()
+
+    def unlink(self):
+        self._arrays.unlink()
+
+
+class SharedPriorityRing(object):
+    """Ring of (index, priority) updates in shared memory from the learner to the sampler.
+
+    It takes the place of the priorities queue: the learner `put`s its updates without ever blocking
+    and the sampler `drain`s everything committed since its last call in one go, keeping only the
+    latest priority of every index. When the learner laps the sampler the oldest updates are lost,
+    they would have been stale anyway.
+    """
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._arrays = SharedArrays([
+            ('idx', (capacity,), np.int64),
+            ('priority', (capacity,), np.float64),
+            ('commit', (capacity,), np.int64),
+        ])
+        self._cursor = mp.Value('q', 0)
+        self._read_seq = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_read_seq'] = 0
+        return state
+
+    def put(self, item, block=True, timeout=None):
+        """Publish the updates of one batch (learner side), same call as on the priorities queue."""
+        idxes, priorities = item
+        idxes = np.asarray(idxes, dtype=np.int64).flatten()[-self._capacity:]
+        priorities = np.asarray(priorities, dtype=np.float64).flatten()[-self._capacity:]
+        with self._cursor.get_lock():
+            seq = self._cursor.value
+            self._cursor.value += len(idxes)
+        seqs = seq + np.arange(len(idxes))
+        slots = seqs % self._capacity
+        # invalidate the slots first, a reader copying the previous lap must not mistake them for intact
+        with self._cursor.get_lock():
+            self._arrays['commit'][slots] = -1
+        self._arrays['idx'][slots] = idxes
+        self._arrays['priority'][slots] = priorities
+        with self._cursor.get_lock():
+            self._arrays['commit'][slots] = seqs + 1
+
+    def put_nowait(self, item):
+        self.put(item)
+
+    def get_nowait(self):
+        raise queue.Empty
+
+    def drain(self):
+        """Take all the committed updates (sampler side).
+        :return: (idxes, priorities) with every index once, at its most recent priority
+        """
+        with self._cursor.get_lock():
+            cursor = self._cursor.value
+            start = max(self._read_seq, cursor - self._capacity)
+            seqs = np.arange(start, cursor)
+            slots = seqs % self._capacity
+            committed = self._arrays['commit'][slots] == seqs + 1
+        num_ready = len(seqs) if committed.all() else int(np.argmin(committed))
+        seqs, slots = seqs[:num_ready], slots[:num_ready]
+        idxes, priorities = self._arrays['idx'][slots].copy(), self._arrays['priority'][slots].copy()
+        # drop what the learner started to overwrite while it was being copied: it invalidates the commit
+        # before touching the data, so a slot still committed to the same sequence afterwards was never torn
+        with self._cursor.get_lock():
+            intact = self._arrays['commit'][slots] == seqs + 1
+        idxes, priorities = idxes[intact], priorities[intact]
+        self._read_seq = start + num_ready
+        # coalesce repeated indexes to their latest update
+        _, last = np.unique(idxes[::-1], return_index=True)
+        keep = len(idxes) - 1 - last
+        return idxes[keep], priorities[keep]
+
+    def close(self):
+        self._arrays.close()
+
+    def unlink(self):
+        self._arrays.unlink()
+
+
+class SharedObsStats(object):
+    """Snapshots of the running observation statistics in shared memory, one row per sampler shard.
+
+    Every shard publishes its own running moments under a seqlock (the version is odd while the row is
+    being written). Readers (learners, agents, the samplers themselves) merge the rows into a single
+    RunningMeanStd and only redo it when a version moved, so the per step cost is one small compare.
+    A row that stays odd (a writer preempted or killed mid-publish) is not waited on, its last intact
+    copy is merged instead.
+    """
+    read_retries = 100
+
+    def __init__(self, state_dim, num_writers=1):
+        self._arrays = SharedArrays([
+            ('mean', (num_writers, state_dim), np.float64),
+            ('var', (num_writers, state_dim), np.float64),
+            ('count', (num_writers,), np.float64),
+            ('version', (num_writers,), np.int64),
+        ])
+        self._state_dim = state_dim
+        self._versions = None
+        self._snapshot = RunningMeanStd(state_dim)
+        self._rows = [None] * num_writers  # last intact (version, mean, var, count) of every row
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_versions'] = None
+        state['_rows'] = [None] * len(self._rows)
+        return state
+
+    def publish(self, writer, rms):
+        """Overwrite the row of `writer` with the moments of `rms` (sampler side)."""
+        version = self._arrays['version']
+        version[writer] += 1
+        self._arrays['mean'][writer] = rms.mean
+        self._arrays['var'][writer] = rms.var
+        self._arrays['count'][writer] = rms.count
+        version[writer] += 1
+
+    def _read_row(self, writer):
+        """Consistent copy of a row, the last intact one when the writer does not finish within the retries."""
+        version = self._arrays['version']
+        for _ in range(self.read_retries):
+            before = version[writer]
+            if before % 2 == 0:
+                mean = self._arrays['mean'][writer].copy()
+                var = self._arrays['var'][writer].copy()
+                count = float(self._arrays['count'][writer])
+                if version[writer] == before:
+                    self._rows[writer] = before, mean, var, count
+                    return self._rows[writer]
+        if self._rows[writer] is None:
+            return -1, None, None, 0.0  # nothing intact was ever read, the row holds no data yet
+        return self._rows[writer]
+
+    def get(self):
+        """Merged statistics of all the shards, rebuilt only when one of them published since the last call."""
+        versions = self._arrays['version'].copy()
+        if self._versions is not None and np.array_equal(versions, self._versions):
+            return self._snapshot
+        snapshot, read_versions = RunningMeanStd(self._state_dim), []
+        for writer in range(len(versions)):
+            version, mean, var, count = self._read_row(writer)
+            read_versions.append(version)
+            if count > 0:
+                snapshot.merge(mean, var, count)
+        self._snapshot, self._versions = snapshot, np.array(read_versions)
+        return snapshot
+
+    def close(self):
+        self._arrays.close()
+
+    def unlink(self):
+        self._arrays.unlink()
+
+
+class SharedPolicyWeights(object):
+    """Latest parameters of a policy as flat float32 buffers in shared memory, double-buffered.
+
+    The writer (learner) fills the buffer readers are not looking at and then bumps the version, whose
+    parity tells which buffer holds the current parameters. Readers (agents) copy the current buffer
+    whenever the version moved since their last read and check the version again afterwards, they only
+    retry in the rare case that two publications happened during their copy. Nobody takes a lock and
+    nothing is pickled or queued per reader.
+    """
+    def __init__(self, num_params):
+        self._arrays = SharedArrays([
+            ('weights', (2, num_params), np.float32),
+            ('version', (1,), np.int64),
+            ('writing', (1,), np.int64),  # version being written, ahead of `version` during a publication
+        ])
+        self._read_version = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_read_version'] = 0
+        return state
+
+    @property
+    def version(self):
+        return int(self._arrays['version'][0])
+
+    def publish(self, module):
+        """Write the parameters of `module` as the new version (single writer)."""
+        version = self._arrays['version']
+        next_version = int(version[0]) + 1
+        self._arrays['writing'][0] = next_version
+        spare = torch.from_numpy(self._arrays['weights'][next_version % 2])
+        with torch.no_grad():
+            spare.copy_(torch.nn.utils.parameters_to_vector(module.parameters()).detach())
+        version[0] = next_version
+
+    def load_into(self, module):
+        """Copy the current parameters into `module` if they changed since the last call.
+        :return: True when new parameters were loaded
+        """
+        version = self._arrays['version']
+        while True:
+            current = int(version[0])
+            if current == self._read_version:
+                return False
+            snapshot = torch.from_numpy(self._arrays['weights'][current % 2].copy())
+            # the buffer is only rewritten by the publication after the next one
+            if int(self._arrays['writing'][0]) - current < 2:
+                break
+        with torch.no_grad():
+            offset = 0
+            for param in module.parameters():
+                num = param.numel()
+                param.copy_(snapshot[offset:offset + num].view_as(param))
+                offset += num
+        self._read_version = current
+        return True
+
+    def close(self):
+        self._arrays.close()
+
+    def unlink(self):
+        self._arrays.unlink()
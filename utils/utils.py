@@ -1,94 +1,110 @@
 from typing import Any, Dict, List, Optional, Tuple, Union
 from torch.nn import functional as F
+from utils.compact_storage import storage_array, storage_columns, restore_storage
+from utils.replay_io import save_columns, load_columns
 from collections import deque
 from gym import spaces
 from enum import Enum
 import numpy as np
-import operator
 import warnings
 import random
-import pickle
+import queue
 import torch
 import os
 
 
 class SegmentTree(object):
     def __init__(self, capacity, operation, neutral_element):
+        """Array backed segment tree, leaves live in `_value[capacity:]`.
+        `operation` must be a numpy ufunc so that whole tree levels can be updated at once.
+        """
         assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
         self._capacity = capacity
         self.neutral_element = neutral_element
-        self._value = [neutral_element for _ in range(2 * capacity)]
+        self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
         self._operation = operation
 
-    def _reduce_helper(self, start, end, node, node_start, node_end):
-        if start == node_start and end == node_end:
-            return self._value[node]
-        mid = (node_start + node_end) // 2
-        if end <= mid:
-            return self._reduce_helper(start, end, 2 * node, node_start, mid)
-        else:
-            if mid + 1 <= start:
-                return self._reduce_helper(start, end, 2 * node + 1, mid + 1, node_end)
-            else:
-                return self._operation(
-                    self._reduce_helper(start, mid, 2 * node, node_start, mid),
-                    self._reduce_helper(mid + 1, end, 2 * node + 1, mid + 1, node_end)
-                )
-
     def reduce(self, start=0, end=None):
         if end is None:
             end = self._capacity
         if end < 0:
             end += self._capacity
-        end -= 1
-        return self._reduce_helper(start, end, 1, 0, self._capacity - 1)
+        if start == 0 and end == self._capacity:
+            return self._value[1]
+        # iterative bottom-up reduction over the half open range [start, end)
+        result = self.neutral_element
+        start += self._capacity
+        end += self._capacity
+        while start < end:
+            if start & 1:
+                result = self._operation(result, self._value[start])
+                start += 1
+            if end & 1:
+                end -= 1
+                result = self._operation(result, self._value[end])
+            start //= 2
+            end //= 2
+        return result
+
+    def _update_parents(self, idx):
+        # propagate one tree level per pass for all updated leaves at once
+        idx = np.unique(idx // 2)
+        while True:
+            self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
+            if idx[0] == 1:
+                break
+            idx = np.unique(idx // 2)
 
     def __setitem__(self, idx, val):
         # index of the leaf
-        idx += self._capacity
+        idx = np.atleast_1d(np.asarray(idx, dtype=np.int64)) + self._capacity
+        if idx.size == 0:
+            return
         self._value[idx] = val
-        idx //= 2
-        while idx >= 1:
-            self._value[idx] = self._operation(
-                self._value[2 * idx],
-                self._value[2 * idx + 1]
-            )
-            idx //= 2
+        self._update_parents(idx)
 
     def __getitem__(self, idx):
-        assert 0 <= idx < self._capacity
+        idx = np.asarray(idx, dtype=np.int64)
+        assert np.all((0 <= idx) & (idx < self._capacity))
         return self._value[self._capacity + idx]
 
     def remove_items(self, num_items):
-        del self._value[self._capacity:(self._capacity + num_items)]
-        neutral_elements = [self.neutral_element for _ in range(num_items)]
-        self._value += neutral_elements
-        for idx in range(self._capacity - 1, 0, -1):
+        leaves = self._value[self._capacity:]
+        leaves[:self._capacity - num_items] = leaves[num_items:].copy()
+        leaves[self._capacity - num_items:] = self.neutral_element
+        # rebuild the internal nodes level by level
+        level = self._capacity // 2
+        while level >= 1:
+            idx = np.arange(level, 2 * level)
             self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
+            level //= 2
 
 
 class SumSegmentTree(SegmentTree):
     def __init__(self, capacity):
-        super(SumSegmentTree, self).__init__(capacity=capacity, operation=operator.add, neutral_element=0.0)
+        super(SumSegmentTree, self).__init__(capacity=capacity, operation=np.add, neutral_element=0.0)
 
     def sum(self, start=0, end=None):
         return super(SumSegmentTree, self).reduce(start, end)
 
     def find_prefixsum_idx(self, prefixsum):
-        assert 0 <= prefixsum <= self.sum() + 1e-5
-        idx = 1
-        while idx < self._capacity:  # while non-leaf
-            if self._value[2 * idx] > prefixsum:
-                idx = 2 * idx
-            else:
-                prefixsum -= self._value[2 * idx]
-                idx = 2 * idx + 1
-        return idx - self._capacity
+        """Find the leaf for each prefix sum, `prefixsum` may be a scalar or an array (batched descent)."""
+        prefixsum = np.array(prefixsum, dtype=np.float64)
+        assert np.all((0 <= prefixsum) & (prefixsum <= self.sum() + 1e-5))
+        idx = np.ones(prefixsum.shape, dtype=np.int64)
+        while idx.flat[0] < self._capacity:  # while non-leaf, every query sits on the same level
+            left = self._value[2 * idx]
+            # never step into an empty right subtree because of rounding errors
+            go_right = (prefixsum >= left) & (self._value[2 * idx + 1] > 0)
+            prefixsum -= np.where(go_right, left, 0.0)
+            idx = 2 * idx + go_right
+        idx -= self._capacity
+        return int(idx) if idx.ndim == 0 else idx
 
 
 class MinSegmentTree(SegmentTree):
     def __init__(self, capacity):
-        super(MinSegmentTree, self).__init__(capacity=capacity, operation=min, neutral_element=float('inf'))
+        super(MinSegmentTree, self).__init__(capacity=capacity, operation=np.minimum, neutral_element=float('inf'))
 
     def min(self, start=0, end=None):
         return super(MinSegmentTree, self).reduce(start, end)
@@ -143,14 +159,31 @@ class ReplayBuffer(object):
         self._storage = []
         self._maxsize = size
         self._next_idx = 0
+        self._num_added = 0
 
     def __len__(self):
         return len(self._storage)
 
+    @property
+    def num_added(self):
+        """Total number of transitions inserted since the buffer was created."""
+        return self._num_added
+
     def add(self, obs_t, action, reward, obs_tp1, done, gamma):
         data = (obs_t, action, reward, obs_tp1, done, gamma)
         self._storage.append(data)
         self._next_idx += 1
+        self._num_added += 1
+
+    def add_episode(self, obs, action, reward, next_obs, done, gamma):
+        for i in range(len(reward)):
+            obs_t = {key: value[i] for key, value in obs.items()} if isinstance(obs, dict) else obs[i]
+            obs_tp1 = {key: value[i] for key, value in next_obs.items()} if isinstance(next_obs, dict) else next_obs[i]
+            self.add(obs_t, action[i], reward[i], obs_tp1, done[i], gamma[i])
+
+    def add_batch(self, batch):
+        """Insert a chunk of consecutive transitions, a structured array from `stack_transitions` or a dict of columns."""
+        self.add_episode(*(batch[key] for key in ('obs', 'action', 'reward', 'next_obs', 'done', 'gamma')))
 
     def remove(self, num_samples):
         del self._storage[:num_samples]
@@ -197,12 +230,204 @@ class ReplayBuffer(object):
         inds = np.zeros(len(idxes))
         return self._encode_sample(idxes) + [weights, inds]
 
+    def get_recent(self, num_samples):
+        """Columns (flat observations) of the `num_samples` most recently inserted transitions, oldest first."""
+        num_samples = min(num_samples, len(self._storage))
+        return self._columns(self._storage[len(self._storage) - num_samples:])
+
+    def _columns(self, storage=None):
+        obses_t, actions, rewards, obses_tp1, dones, gammas = zip(*(self._storage if storage is None else storage))
+        return {'obs': np.stack([flatten_obs(o) for o in obses_t]).astype(np.float32),
+                'action': np.asarray(actions, dtype=np.float32), 'reward': np.asarray(rewards, dtype=np.float32),
+                'next_obs': np.stack([flatten_obs(o) for o in obses_tp1]).astype(np.float32),
+                'done': np.asarray(dones, dtype=np.float32), 'gamma': np.asarray(gammas, dtype=np.float32)}
+
     def dump(self, save_dir):
-        fn = os.path.join(save_dir, "replay_buffer.pkl")
-        with open(fn, 'wb') as f:
-            pickle.dump(self._storage, f)
+        fn = os.path.join(save_dir, "replay_buffer")
+        save_columns(fn, self._columns() if len(self._storage) > 0 else {}, {'size': len(self._storage)})
         print(f"Buffer dumped to {fn}")
 
+    def load(self, save_dir, mmap_mode='c'):
+        """Reopen a buffer written by `dump`, the rows stay memory mapped."""
+        columns, meta = load_columns(os.path.join(save_dir, "replay_buffer"), mmap_mode=mmap_mode)
+        if meta['size'] > 0:
+            self._storage = list(zip(*[columns[key] for key in ('obs', 'action', 'reward', 'next_obs', 'done', 'gamma')]))
+        self._next_idx = len(self._storage)
+        return meta
+
+
+def flatten_obs(obs):
+    """Concatenate dict observations (observation, achieved_goal, desired_goal) into a flat state."""
+    if isinstance(obs, dict):
+        return np.concatenate([np.asarray(v) for v in obs.values()], axis=-1)
+    if isinstance(obs, torch.Tensor):
+        return obs  # already flat, sampled by the learner resident replay buffer
+    obs = np.asarray(obs)
+    if obs.dtype == object:
+        # batch of dict observations gathered from the list based buffers
+        return np.stack([flatten_obs(o) for o in obs])
+    return obs
+
+
+def to_tensor(value, device):
+    """float32 tensor on `device` for a field of a sampled batch, numpy arrays are wrapped without a copy first."""
+    if isinstance(value, torch.Tensor):
+        return value.to(device=device, dtype=torch.float32)
+    return torch.from_numpy(np.asarray(value)).float().to(device)
+
+
+def to_numpy(value):
+    """Numpy array for a field of a sampled batch, tensors are copied back from their device."""
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().numpy()
+    return np.asarray(value)
+
+
+class ArrayReplayBuffer(object):
+    def __init__(self, size, state_dim, action_dim, shared_storage=None, obs_dtype='float32', action_dtype='float32'):
+        """
+        Create ring buffer backed replay buffer.
+        Args:
+            size (int): max number of transitions to store in the buffer. When the buffer
+            overflows the oldest transitions are overwritten in place.
+            state_dim (int): dimension of the (flattened) observations
+            action_dim (int): dimension of the actions
+            shared_storage (SharedReplayStorage): shared memory ring written directly by the
+            agents, new transitions are picked up with `sync()` instead of `add()`
+            obs_dtype, action_dtype (str): storage precision of the observations and actions, float32,
+            float16, int8 or uint16 (see CompactArray). Samples are always decoded to float32.
+        """
+        self._maxsize = size
+        self._next_idx = 0
+        self._size = 0
+        self._num_added = 0
+        self._shared = shared_storage
+        if shared_storage is not None:
+            assert len(shared_storage) == size, "Shared storage and replay buffer sizes differ"
+            assert obs_dtype == action_dtype == 'float32', "Shared storage is written as float32 by the agents"
+            self._storage = shared_storage.storage
+            return
+        self._storage = self._make_storage(size, state_dim, action_dim, obs_dtype, action_dtype)
+
+    def _make_storage(self, size, state_dim, action_dim, obs_dtype, action_dtype):
+        return {
+            'obs': storage_array((size, state_dim), obs_dtype),
+            'action': storage_array((size, action_dim), action_dtype),
+            'reward': np.zeros(size, dtype=np.float32),
+            'next_obs': storage_array((size, state_dim), obs_dtype),
+            'done': np.zeros(size, dtype=np.float32),
+            'gamma': np.zeros(size, dtype=np.float32),
+        }
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def num_added(self):
+        """Total number of transitions inserted since the buffer was created."""
+        return self._num_added
+
+    def _commit(self, num_samples):
+        """Advance the ring pointers over `num_samples` freshly written slots and return their indexes."""
+        idxes = (self._next_idx + np.arange(min(num_samples, self._maxsize))) % self._maxsize
+        self._next_idx = (self._next_idx + num_samples) % self._maxsize
+        self._size = min(self._size + num_samples, self._maxsize)
+        self._num_added += num_samples
+        return idxes
+
+    def get_recent(self, num_samples):
+        """Columns of the `num_samples` most recently inserted transitions, oldest first."""
+        num_samples = min(num_samples, self._size)
+        idxes = (self._next_idx - num_samples + np.arange(num_samples)) % self._maxsize
+        return dict(zip(('obs', 'action', 'reward', 'next_obs', 'done', 'gamma'), self._encode_sample(idxes)))
+
+    def add(self, obs_t, action, reward, obs_tp1, done, gamma):
+        assert self._shared is None, "The agents write into shared storage, use sync()"
+        idx = self._next_idx
+        self._storage['obs'][idx] = flatten_obs(obs_t)
+        self._storage['action'][idx] = action
+        self._storage['reward'][idx] = reward
+        self._storage['next_obs'][idx] = flatten_obs(obs_tp1)
+        self._storage['done'][idx] = done
+        self._storage['gamma'][idx] = gamma
+        self._commit(1)
+
+    def add_episode(self, obs, action, reward, next_obs, done, gamma):
+        assert self._shared is None, "The agents write into shared storage, use sync()"
+        num_samples = min(len(reward), self._maxsize)
+        idxes = (self._next_idx + np.arange(num_samples)) % self._maxsize
+        self._storage['obs'][idxes] = flatten_obs(obs)[-num_samples:]
+        self._storage['action'][idxes] = action[-num_samples:]
+        self._storage['reward'][idxes] = reward[-num_samples:]
+        self._storage['next_obs'][idxes] = flatten_obs(next_obs)[-num_samples:]
+        self._storage['done'][idxes] = done[-num_samples:]
+        self._storage['gamma'][idxes] = gamma[-num_samples:]
+        self._commit(num_samples)
+
+    def add_batch(self, batch):
+        """Insert a chunk of consecutive transitions, a structured array from `stack_transitions` or a dict of columns."""
+        self.add_episode(*(batch[key] for key in ('obs', 'action', 'reward', 'next_obs', 'done', 'gamma')))
+
+    def sync(self):
+        """Pick up the transitions committed by the agents into the shared storage."""
+        if self._shared is None:
+            return 0
+        num_samples = self._shared.poll()
+        if num_samples:
+            self._commit(num_samples)
+        return num_samples
+
+    def remove(self, num_samples):
+        # Evicting the oldest transitions only shrinks the valid window, the slots are overwritten later
+        self._size = max(self._size - num_samples, 0)
+
+    def _valid_idxes(self, positions):
+        """Map positions in [0, len) (oldest first) to slots of the ring."""
+        return (self._next_idx - self._size + positions) % self._maxsize
+
+    def _num_in_flight(self):
+        """Number of the oldest stored transitions whose slots the agents may be overwriting right now."""
+        if self._shared is None:
+            return 0
+        # reservations only reach the window once they run past the free slots of the ring
+        return min(max(self._shared.num_in_flight() - (self._maxsize - self._size), 0), self._size)
+
+    def _encode_sample(self, idxes, n_step=None):
+        assert n_step is None, "N-step returns at sample time need the episode layout (EpisodeReplayBuffer)"
+        return [self._storage[key][idxes] for key in ('obs', 'action', 'reward', 'next_obs', 'done', 'gamma')]
+
+    def sample(self, batch_size, n_step=None, **kwags):
+        """Sample a batch of experiences.
+        See ReplayBuffer.sample, each field is gathered with a single fancy-indexing pass.
+        """
+        num_in_flight = self._num_in_flight()
+        if num_in_flight >= self._size:
+            raise queue.Empty  # every stored slot is being rewritten by the agents
+        idxes = self._valid_idxes(np.random.randint(num_in_flight, self._size, batch_size))
+        weights = np.zeros(batch_size, dtype=np.float32)
+        return self._encode_sample(idxes, n_step) + [weights, idxes]
+
+    def _meta(self):
+        return {'size': self._size, 'next_idx': self._next_idx, 'maxsize': self._maxsize}
+
+    def dump(self, save_dir):
+        fn = os.path.join(save_dir, "replay_buffer")
+        save_columns(fn, storage_columns(self._storage), self._meta())
+        print(f"Buffer dumped to {fn}")
+
+    def load(self, save_dir, mmap_mode='c'):
+        """
+        Reopen a buffer written by `dump`. The fields are memory mapped (copy-on-write by default) so
+        training resumes at once without reading the whole buffer into RAM. Buffers over shared storage
+        cannot be reopened, the agents write into the ring from its first slot.
+        """
+        assert self._shared is None, "A buffer over shared storage cannot be resumed"
+        columns, meta = load_columns(os.path.join(save_dir, "replay_buffer"), mmap_mode=mmap_mode)
+        assert meta['maxsize'] == self._maxsize, "Saved buffer has a different capacity"
+        restore_storage(self._storage, columns)
+        self._size, self._next_idx = meta['size'], meta['next_idx']
+        return meta
+
 
 class GoalSelectionStrategy(Enum):
     """
@@ -270,14 +495,17 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         self._it_min.remove_items(num_samples)
 
     def _sample_proportional(self, batch_size):
-        res = []
         p_total = self._it_sum.sum(0, len(self._storage) - 1)
         every_range_len = p_total / batch_size
-        for i in range(batch_size):
-            mass = random.random() * every_range_len + i * every_range_len
-            idx = self._it_sum.find_prefixsum_idx(mass)
-            res.append(idx)
-        return res
+        mass = (np.random.random(batch_size) + np.arange(batch_size)) * every_range_len
+        return self._it_sum.find_prefixsum_idx(mass)
+
+    def _compute_weights(self, idxes, beta, num_stored):
+        p_total = self._it_sum.sum()
+        p_min = self._it_min.min() / p_total
+        max_weight = (p_min * num_stored) ** (-beta)
+        p_sample = self._it_sum[idxes] / p_total
+        return (p_sample * num_stored) ** (-beta) / max_weight
 
     def sample(self, batch_size, beta=0.6):
         """Sample a batch of experiences.
@@ -316,19 +544,14 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         assert beta > 0
 
         idxes = self._sample_proportional(batch_size)
-
-        weights = []
-        p_min = self._it_min.min() / self._it_sum.sum()
-        max_weight = (p_min * len(self._storage)) ** (-beta)
-
-        for idx in idxes:
-            p_sample = self._it_sum[idx] / self._it_sum.sum()
-            weight = (p_sample * len(self._storage)) ** (-beta)
-            weights.append(weight / max_weight)
-        weights = np.array(weights)
+        weights = self._compute_weights(idxes, beta, len(self._storage))
         encoded_sample = self._encode_sample(idxes)
         return tuple(list(encoded_sample) + [weights, idxes])
 
+    def min_probability(self):
+        """Smallest sampling probability of a stored transition, the reference of the importance weights."""
+        return self._it_min.min() / self._it_sum.sum()
+
     def update_priorities(self, idxes, priorities):
         """Update priorities of sampled transitions.
         sets priority of transition at index idxes[i] in buffer
@@ -342,21 +565,234 @@ class PrioritizedReplayBuffer(ReplayBuffer):
             transitions at the sampled idxes denoted by
             variable `idxes`.
         """
+        idxes = np.asarray(idxes, dtype=np.int64).flatten()
+        priorities = np.asarray(priorities, dtype=np.float64).flatten()
         assert len(idxes) == len(priorities)
-        for idx, priority in zip(idxes, priorities):
-            assert priority > 0
-            assert 0 <= idx  # < len(self._storage)
-            idx = int(idx)
-            self._it_sum[idx] = priority ** self._alpha
-            self._it_min[idx] = priority ** self._alpha
-            self._max_priority = max(self._max_priority, priority)
+        assert np.all(priorities > 0)
+        assert np.all(0 <= idxes)  # < len(self._storage)
+        self._it_sum[idxes] = priorities ** self._alpha
+        self._it_min[idxes] = priorities ** self._alpha
+        self._max_priority = max(self._max_priority, priorities.max(initial=0.0))
 
     def dump(self, save_dir):
-        fn = os.path.join(save_dir, "replay_buffer.pkl")
-        with open(fn, 'wb') as f:
-            pickle.dump(self._storage, f)
+        fn = os.path.join(save_dir, "replay_buffer")
+        columns = self._columns() if len(self._storage) > 0 else {}
+        columns['priority'] = self._it_sum[np.arange(len(self._storage))]
+        save_columns(fn, columns, {'size': len(self._storage), 'max_priority': self._max_priority})
         print(f"Buffer dumped to {fn}")
 
+    def load(self, save_dir, mmap_mode='c'):
+        meta = super().load(save_dir, mmap_mode=mmap_mode)
+        priority = np.load(os.path.join(save_dir, "replay_buffer", "priority.npy"))
+        self._it_sum[np.arange(len(priority))] = priority
+        self._it_min[np.arange(len(priority))] = priority
+        self._max_priority = meta['max_priority']
+        return meta
+
+
+class PrioritizedArrayReplayBuffer(ArrayReplayBuffer):
+    def __init__(self, size, state_dim, action_dim, alpha, shared_storage=None, **kwargs):
+        """Create Prioritized Replay buffer on top of the ring buffer storage.
+        The segment trees are indexed by ring slot, so evicting a transition only overwrites its
+        leaf (log(capacity) nodes) and the indexes handed to the learner stay valid until their
+        slot is overwritten.
+        See Also
+        --------
+        ArrayReplayBuffer.__init__, PrioritizedReplayBuffer.__init__
+        """
+        super(PrioritizedArrayReplayBuffer, self).__init__(size, state_dim, action_dim, shared_storage=shared_storage,
+                                                           **kwargs)
+        assert alpha >= 0
+        self._alpha = alpha
+
+        self.it_capacity = 1
+        while self.it_capacity < size:
+            self.it_capacity *= 2
+
+        self._it_sum = SumSegmentTree(self.it_capacity)
+        self._it_min = MinSegmentTree(self.it_capacity)
+        self._max_priority = 1.0
+
+    def _commit(self, num_samples):
+        idxes = super()._commit(num_samples)
+        self._it_sum[idxes] = self._max_priority ** self._alpha
+        self._it_min[idxes] = self._max_priority ** self._alpha
+        return idxes
+
+    def remove(self, num_samples):
+        num_samples = min(num_samples, self._size)
+        idxes = self._valid_idxes(np.arange(num_samples))
+        super().remove(num_samples)
+        self._it_sum[idxes] = self._it_sum.neutral_element
+        self._it_min[idxes] = self._it_min.neutral_element
+
+    def sample(self, batch_size, beta=0.6, n_step=None, **kwargs):
+        """Sample a batch of experiences, see PrioritizedReplayBuffer.sample."""
+        assert beta > 0
+        # slots being overwritten by the agents get a zero priority until they are committed again
+        num_in_flight = self._num_in_flight()
+        if num_in_flight >= self._size:
+            raise queue.Empty  # every stored slot is being rewritten by the agents
+        in_flight = self._valid_idxes(np.arange(num_in_flight))
+        self._it_sum[in_flight] = self._it_sum.neutral_element
+        self._it_min[in_flight] = self._it_min.neutral_element
+        every_range_len = self._it_sum.sum() / batch_size
+        mass = (np.random.random(batch_size) + np.arange(batch_size)) * every_range_len
+        idxes = self._it_sum.find_prefixsum_idx(mass)
+
+        p_total = self._it_sum.sum()
+        max_weight = (self._it_min.min() / p_total * self._size) ** (-beta)
+        weights = (self._it_sum[idxes] / p_total * self._size) ** (-beta) / max_weight
+        return self._encode_sample(idxes, n_step) + [weights, idxes]
+
+    def min_probability(self):
+        """Smallest sampling probability of a stored transition, the reference of the importance weights."""
+        return self._it_min.min() / self._it_sum.sum()
+
+    def update_priorities(self, idxes, priorities):
+        """Update priorities of sampled transitions, see PrioritizedReplayBuffer.update_priorities.
+        Updates for slots that were evicted in the meantime are dropped.
+        """
+        idxes = np.asarray(idxes, dtype=np.int64).flatten()
+        priorities = np.asarray(priorities, dtype=np.float64).flatten()
+        assert len(idxes) == len(priorities)
+        assert np.all(priorities > 0)
+        assert np.all((0 <= idxes) & (idxes < self._maxsize))
+        live = self._it_sum[idxes] > 0
+        idxes, priorities = idxes[live], priorities[live]
+        self._it_sum[idxes] = priorities ** self._alpha
+        self._it_min[idxes] = priorities ** self._alpha
+        self._max_priority = max(self._max_priority, priorities.max(initial=0.0))
+
+    def dump(self, save_dir):
+        fn = os.path.join(save_dir, "replay_buffer")
+        columns = dict(storage_columns(self._storage), priority=self._it_sum[np.arange(self._maxsize)])
+        save_columns(fn, columns, dict(self._meta(), max_priority=self._max_priority))
+        print(f"Buffer dumped to {fn}")
+
+    def load(self, save_dir, mmap_mode='c'):
+        meta = super().load(save_dir, mmap_mode=mmap_mode)
+        # the leaves are stored already raised to alpha
+        priority = np.load(os.path.join(save_dir, "replay_buffer", "priority.npy"))
+        self._it_sum[np.arange(self._maxsize)] = priority
+        self._it_min[np.arange(self._maxsize)] = np.where(priority > 0, priority, self._it_min.neutral_element)
+        self._max_priority = meta['max_priority']
+        return meta
+
+
+class EpisodeReplayBuffer(ArrayReplayBuffer):
+    def __init__(self, size, state_dim, action_dim, n_step=1, shared_storage=None, **kwargs):
+        """
+        Ring buffer that stores every observation once.
+        Episodes are written as a contiguous run of T + 1 states, the row of state t also holds the
+        transition taken from it and the last row only closes the episode. The next state of a
+        transition is the row `next_offset` ahead, i.e. min(t + n_step, T), which is exactly what the
+        agents bootstrap from with N-step returns. Closing rows count towards the capacity but are
+        never sampled.
+        Args:
+            n_step (int): N-step return horizon the transitions were collected with. With raw 1-step
+            transitions the returns can instead be computed when sampling, for any horizon.
+            See ArrayReplayBuffer.__init__ for the other arguments.
+        """
+        assert shared_storage is None, "The agents write full transitions into shared storage"
+        self._n_step = n_step
+        super(EpisodeReplayBuffer, self).__init__(size, state_dim, action_dim, **kwargs)
+
+    def _make_storage(self, size, state_dim, action_dim, obs_dtype, action_dtype):
+        storage = super()._make_storage(size, state_dim, action_dim, obs_dtype, action_dtype)
+        del storage['next_obs']
+        # rows between a state and its next state, 0 marks the closing row of an episode
+        storage['next_offset'] = np.zeros(size, dtype=np.int16)
+        return storage
+
+    def add(self, obs_t, action, reward, obs_tp1, done, gamma):
+        # a lone transition is an episode of one step, no state is shared with its neighbours
+        self._write_rows(np.stack([flatten_obs(obs_t), flatten_obs(obs_tp1)]), [action], [reward], [done], [gamma],
+                         np.ones(1, dtype=np.int16))
+
+    def add_episode(self, obs, action, reward, next_obs, done, gamma):
+        """
+        Store the N-step transitions of one episode (see `stack_transitions`), in order and without gaps.
+        Only the last next state is kept, the other ones are the states `n_step` rows ahead.
+        """
+        num_transitions = len(reward)
+        steps = np.arange(num_transitions)
+        offsets = np.minimum(steps + self._n_step, num_transitions) - steps
+        states = np.concatenate([flatten_obs(obs), flatten_obs(next_obs)[-1:]])
+        self._write_rows(states, action, reward, done, gamma, offsets)
+
+    def _write_rows(self, states, action, reward, done, gamma, offsets):
+        num_rows = min(len(states), self._maxsize)
+        idxes = (self._next_idx + np.arange(num_rows)) % self._maxsize
+        transitions = idxes[:-1]
+        self._storage['obs'][idxes] = states[-num_rows:]
+        self._storage['action'][transitions] = np.asarray(action)[len(action) - num_rows + 1:]
+        self._storage['reward'][transitions] = np.asarray(reward)[len(reward) - num_rows + 1:]
+        self._storage['done'][transitions] = np.asarray(done)[len(done) - num_rows + 1:]
+        self._storage['gamma'][transitions] = np.asarray(gamma)[len(gamma) - num_rows + 1:]
+        self._storage['next_offset'][transitions] = offsets[len(offsets) - num_rows + 1:]
+        self._storage['next_offset'][idxes[-1]] = 0
+        self._commit(num_rows)
+
+    def _encode_sample(self, idxes, n_step=None):
+        if n_step is not None:
+            return self._encode_n_step(idxes, n_step)
+        next_idxes = (idxes + self._storage['next_offset'][idxes]) % self._maxsize
+        return [self._storage['obs'][idxes], self._storage['action'][idxes], self._storage['reward'][idxes],
+                self._storage['obs'][next_idxes], self._storage['done'][idxes], self._storage['gamma'][idxes]]
+
+    def _encode_n_step(self, idxes, n_step):
+        """
+        Gather `n_step` return transitions from stored 1-step ones: rewards are summed with the stored
+        discounts until the horizon or the end of the episode, whichever comes first, and the state
+        reached there is the bootstrap state. `gamma` is the product of the discounts used.
+        """
+        assert self._n_step == 1, "The stored transitions already hold N-step returns"
+        reward = np.zeros(len(idxes), dtype=np.float32)
+        gamma = np.ones(len(idxes), dtype=np.float32)
+        done = np.zeros(len(idxes), dtype=np.float32)
+        rows, running = idxes, np.ones(len(idxes), dtype=bool)
+        for _ in range(n_step):
+            reward += np.where(running, gamma * self._storage['reward'][rows], 0.0).astype(np.float32)
+            gamma = np.where(running, gamma * self._storage['gamma'][rows], gamma)
+            done = np.where(running, self._storage['done'][rows], done)
+            rows = np.where(running, (rows + 1) % self._maxsize, rows)
+            running &= self._storage['next_offset'][rows] > 0
+        return [self._storage['obs'][idxes], self._storage['action'][idxes], reward, self._storage['obs'][rows], done,
+                gamma]
+
+    def sample(self, batch_size, n_step=None, **kwags):
+        """Sample a batch of experiences, see ArrayReplayBuffer.sample. Closing rows are drawn again."""
+        idxes = self._valid_idxes(np.random.randint(0, self._size, batch_size))
+        closing = self._storage['next_offset'][idxes] == 0
+        while closing.any():
+            idxes[closing] = self._valid_idxes(np.random.randint(0, self._size, closing.sum()))
+            closing = self._storage['next_offset'][idxes] == 0
+        weights = np.zeros(batch_size, dtype=np.float32)
+        return self._encode_sample(idxes, n_step) + [weights, idxes]
+
+    def get_recent(self, num_samples):
+        """
+        Columns of the transitions among the `num_samples` most recently written rows, oldest first.
+        `episode_end` marks the last transition of every episode.
+        """
+        num_samples = min(num_samples, self._size)
+        rows = (self._next_idx - num_samples + np.arange(num_samples)) % self._maxsize
+        idxes = rows[self._storage['next_offset'][rows] > 0]
+        columns = dict(zip(('obs', 'action', 'reward', 'next_obs', 'done', 'gamma'), self._encode_sample(idxes)))
+        columns['episode_end'] = (self._storage['next_offset'][(idxes + 1) % self._maxsize] == 0).astype(np.float32)
+        return columns
+
+
+class PrioritizedEpisodeReplayBuffer(PrioritizedArrayReplayBuffer, EpisodeReplayBuffer):
+    """Prioritized replay on the deduplicated episode layout, closing rows get a zero priority leaf."""
+    def _commit(self, num_samples):
+        idxes = super()._commit(num_samples)
+        closing = idxes[self._storage['next_offset'][idxes] == 0]
+        self._it_sum[closing] = self._it_sum.neutral_element
+        self._it_min[closing] = self._it_min.neutral_element
+        return idxes
+
 
 def get_time_limit(env, current_max_episode_length: Optional[int]) -> int:
     """
@@ -434,8 +870,8 @@ class HerReplayBuffer(ReplayBuffer):
         self.online_sampling = online_sampling
         # compute ratio between HER replays and regular replays in percent for online HER sampling
         self.her_ratio = 1 - (1.0 / (self.n_sampled_goal + 1))
-        # maximum steps in episode
-        self.max_episode_length = config['max_ep_length']
+        # maximum steps in episode, the agents emit one extra transition on the step that hits max_ep_length
+        self.max_episode_length = config['max_ep_length'] + 1
         # storage for transitions of current episode for offline sampling
         # for online sampling, it replaces the "classic" replay buffer completely
         her_buffer_size = config['replay_mem_size']
@@ -464,6 +900,7 @@ class HerReplayBuffer(ReplayBuffer):
         self.full = False
         self.pos = 0
         self.current_idx = 0
+        self._num_added = 0
 
         # Get shape of observation and goal (usually the same)
         self.obs_shape = get_obs_shape(box.Box(shape=[self.config['obs_shape']], high=np.inf, low=-np.inf))
@@ -480,14 +917,16 @@ class HerReplayBuffer(ReplayBuffer):
             "next_achieved_goal": (1,) + self.goal_shape,
             "next_desired_goal": (1,) + self.goal_shape,
             "done": (1,),
+            "gamma": (1,),
         }
         self._observation_keys = ["observation", "achieved_goal", "desired_goal"]
+        # observations and goals (and actions) may be kept in reduced precision, see CompactArray
+        storage_dtypes = {key: config['replay_obs_dtype'] for key in input_shape if 'obs' in key or 'goal' in key}
+        storage_dtypes['action'] = config['replay_action_dtype']
         self._buffer = {
-            key: np.zeros((self.max_episode_stored, self.max_episode_length, *dim), dtype=np.float32)
+            key: storage_array((self.max_episode_stored, self.max_episode_length, *dim), storage_dtypes.get(key, 'float32'))
             for key, dim in input_shape.items()
         }
-        # Store info dicts are it can be used to compute the reward (e.g. continuity cost)
-        self.info_buffer = [deque(maxlen=self.max_episode_length) for _ in range(self.max_episode_stored)]
         # episode length storage, needed for episodes which has less steps than the maximum length
         self.episode_lengths = np.zeros(self.max_episode_stored, dtype=np.int64)
 
@@ -503,12 +942,37 @@ class HerReplayBuffer(ReplayBuffer):
         """
         if self.replay_buffer is not None:
             return self.replay_buffer.sample(batch_size, env)
-        return self._sample_transitions(batch_size, maybe_vec_env=env, online_sampling=True)  # pytype: disable=bad-return-type
+        return self.sample(batch_size)
+
+    def __len__(self):
+        return self.size()
+
+    def remove(self, num_samples):
+        # Old episodes are overwritten in place once the episode storage is full
+        pass
+
+    def sample(self, batch_size, obs_rms=None, **kwargs):
+        """Online HER sampling, see ReplayBuffer.sample.
+        Goals are relabeled with the configured strategy in a few vectorized passes and the
+        observations are returned as flat float32 arrays of size state_dim.
+        :param obs_rms: running statistics of the flat states (RunningMeanStd), normalizes the states when given
+        """
+        transitions = self._sample_transitions(batch_size, maybe_vec_env=None, online_sampling=True)
+        state = self._normalize_obs({key: transitions[key] for key in self._observation_keys}, obs_rms)
+        next_state = self._normalize_obs({
+            "observation": transitions["next_obs"],
+            "achieved_goal": transitions["next_achieved_goal"],
+            # The desired goal for the next observation must be the same as the previous one
+            "desired_goal": transitions["desired_goal"],
+        }, obs_rms)
+        weights = np.zeros(batch_size, dtype=np.float32)
+        return [state, transitions["action"], transitions["reward"][:, 0], next_state, transitions["done"][:, 0],
+                transitions["gamma"][:, 0], weights, transitions["index"]]
 
     def _sample_offline(
         self,
         n_sampled_goal: Optional[int] = None,
-    ) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray], np.ndarray, np.ndarray]:
+    ) -> Dict[str, np.ndarray]:
         """
         Sample function for offline sampling of HER transition,
         in that case, only one episode is used and transitions
@@ -618,7 +1082,7 @@ class HerReplayBuffer(ReplayBuffer):
             if her_indices.size == 0:
                 # Episode of one timestep, not enough for using the "future" strategy
                 # no virtual transitions are created in that case
-                return {}, {}, np.zeros(0), np.zeros(0)
+                return {}
             else:
                 # Repeat every transition index n_sampled_goals times
                 # to sample n_sampled_goal per timestep in the episode (only one is stored).
@@ -627,26 +1091,13 @@ class HerReplayBuffer(ReplayBuffer):
                 episode_indices = episode_indices[transitions_indices]
                 her_indices = np.arange(len(episode_indices))
 
-        # get selected transitions
-        transitions = {key: self._buffer[key][episode_indices, transitions_indices].copy() for key in self._buffer.keys()}
+        # get selected transitions (fancy indexing already returns copies)
+        transitions = {key: self._buffer[key][episode_indices, transitions_indices] for key in self._buffer.keys()}
 
         # sample new desired goals and relabel the transitions
         new_goals = self.sample_goals(episode_indices, her_indices, transitions_indices)
         transitions["desired_goal"][her_indices] = new_goals
 
-        print('Len episode indices:', len(episode_indices))
-        print('Len transitions indices:', len(transitions_indices))
-        # Convert info buffer to numpy array
-        print('Len info buffer:', len(self.info_buffer))
-        print('Len info buffer:', len(self.info_buffer[0]))
-
-        transitions["info"] = np.array(
-            [
-                self.info_buffer[episode_idx][transition_idx]
-                for episode_idx, transition_idx in zip(episode_indices, transitions_indices)
-            ]
-        )
-
         # Edge case: episode of one timesteps with the future strategy
         # no virtual transition can be created
         if len(her_indices) > 0:
@@ -661,30 +1112,26 @@ class HerReplayBuffer(ReplayBuffer):
                 transitions["next_achieved_goal"][her_indices, 0],
                 # here we use the new desired goal
                 transitions["desired_goal"][her_indices, 0],
-                transitions["info"][her_indices, 0],
-            )[0]
-        # concatenate observation with (desired) goal
-        observations = self._normalize_obs(transitions, maybe_vec_env)
-
-        # HACK to make normalize obs and `add()` work with the next observation
-        next_observations = {
-            "observation": transitions["next_obs"],
-            "achieved_goal": transitions["next_achieved_goal"],
-            # The desired goal for the next observation must be the same as the previous one
-            "desired_goal": transitions["desired_goal"],
-        }
-        next_observations = self._normalize_obs(next_observations, maybe_vec_env)
-
-        return observations, next_observations, transitions["action"], transitions["reward"]
+                None,
+            )
+        transitions["next_desired_goal"] = transitions["desired_goal"]
+        transitions["index"] = episode_indices * self.max_episode_length + transitions_indices
+        return transitions
 
-    def _normalize_obs(self, obs: np.ndarray, obs_rms) -> np.ndarray:
+    def _normalize_obs(self, obs: Dict[str, np.ndarray], obs_rms=None) -> np.ndarray:
         """
-        Helper to normalize observation.
+        Helper to concatenate the observation with its goals into a flat state, normalized when statistics are given.
         :param obs:
-        :param obs_rms: associated statistics
-        :return: normalized observation
+        :param obs_rms: associated statistics (object with `mean` and `var`)
+        :return: flat (normalized) observation
         """
-        return np.clip((obs - obs_rms.mean) / np.sqrt(obs_rms.var + self.epsilon), -self.clip_obs, self.clip_obs)
+        flat_obs = np.concatenate([obs[key].reshape(len(obs[key]), -1) for key in self._observation_keys], axis=-1)
+        if obs_rms is None:
+            return flat_obs
+        if getattr(obs_rms, 'count', 1) == 0:
+            return flat_obs  # nothing seen yet
+        return np.clip((flat_obs - obs_rms.mean) / np.sqrt(obs_rms.var + self.epsilon), -self.clip_obs,
+                       self.clip_obs).astype(np.float32)
 
     def reset(self) -> None:
         """
@@ -705,20 +1152,22 @@ class HerReplayBuffer(ReplayBuffer):
         gamma):
 
         if self.current_idx == 0 and self.full:
-            # Clear info buffer
-            self.info_buffer[self.pos] = deque(maxlen=self.max_episode_length)
+            # The oldest episode is being overwritten
+            self.episode_lengths[self.pos] = 0
 
         done_ = done
 
-        self._buffer["observation"][self.pos][self.current_idx] = obs["observation"]
-        self._buffer["achieved_goal"][self.pos][self.current_idx] = obs["achieved_goal"]
-        self._buffer["desired_goal"][self.pos][self.current_idx] = obs["desired_goal"]
-        self._buffer["action"][self.pos][self.current_idx] = action
-        self._buffer["done"][self.pos][self.current_idx] = done_
-        self._buffer["reward"][self.pos][self.current_idx] = reward
-        self._buffer["next_obs"][self.pos][self.current_idx] = next_obs["observation"]
-        self._buffer["next_achieved_goal"][self.pos][self.current_idx] = next_obs["achieved_goal"]
-        self._buffer["next_desired_goal"][self.pos][self.current_idx] = next_obs["desired_goal"]
+        # index in one go, compact fields return decoded copies when indexed
+        self._buffer["observation"][self.pos, self.current_idx] = obs["observation"]
+        self._buffer["achieved_goal"][self.pos, self.current_idx] = obs["achieved_goal"]
+        self._buffer["desired_goal"][self.pos, self.current_idx] = obs["desired_goal"]
+        self._buffer["action"][self.pos, self.current_idx] = action
+        self._buffer["done"][self.pos, self.current_idx] = done_
+        self._buffer["reward"][self.pos, self.current_idx] = reward
+        self._buffer["next_obs"][self.pos, self.current_idx] = next_obs["observation"]
+        self._buffer["next_achieved_goal"][self.pos, self.current_idx] = next_obs["achieved_goal"]
+        self._buffer["next_desired_goal"][self.pos, self.current_idx] = next_obs["desired_goal"]
+        self._buffer["gamma"][self.pos, self.current_idx] = gamma
 
         # When doing offline sampling
         # Add real transition to normal replay buffer
@@ -746,6 +1195,67 @@ class HerReplayBuffer(ReplayBuffer):
 
             self.episode_steps = 0
 
+    def _split_obs(self, flat_obs):
+        """Inverse of `_normalize_obs` without statistics: flat states back to observation and goals."""
+        sizes = np.cumsum([self.obs_shape[0], self.goal_shape[0]])
+        return dict(zip(self._observation_keys, np.split(np.asarray(flat_obs), sizes, axis=-1)))
+
+    def get_recent(self, num_samples):
+        """
+        Columns (flat observations) of the `num_samples` most recently stored transitions, oldest first.
+        Only finished episodes are considered, `episode_end` marks the last transition of every episode.
+        """
+        episodes, total = [], 0
+        for i in range(1, self.n_episodes_stored + 1):
+            if total >= num_samples:
+                break
+            episode = (self.pos - i) % self.max_episode_stored
+            episodes.append(episode)
+            total += self.episode_lengths[episode]
+        episodes = np.array(episodes[::-1], dtype=np.int64)
+        lengths = self.episode_lengths[episodes]
+        episode_indices = np.repeat(episodes, lengths)
+        transitions_indices = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        transitions = {key: self._buffer[key][episode_indices, transitions_indices] for key in self._buffer.keys()}
+        episode_end = np.zeros(len(episode_indices), dtype=np.float32)
+        episode_end[np.cumsum(lengths) - 1] = 1.0
+        columns = {
+            'obs': self._normalize_obs({key: transitions[key] for key in self._observation_keys}),
+            'action': transitions['action'],
+            'reward': transitions['reward'][:, 0],
+            'next_obs': self._normalize_obs({'observation': transitions['next_obs'],
+                                             'achieved_goal': transitions['next_achieved_goal'],
+                                             'desired_goal': transitions['next_desired_goal']}),
+            'done': transitions['done'][:, 0],
+            'gamma': transitions['gamma'][:, 0],
+            'episode_end': episode_end,
+        }
+        return {key: value[len(value) - min(num_samples, len(value)):] for key, value in columns.items()}
+
+    def add_episode(self, obs, action, reward, next_obs, done, gamma):
+        """
+        Store a whole episode at once, every field holds one row per transition (see `stack_transitions`).
+        Observations may be dicts or flat states. Episodes longer than the episode storage are truncated.
+        """
+        if self.current_idx > 0:
+            self.truncate_last_trajectory()
+        if not isinstance(obs, dict):
+            obs, next_obs = self._split_obs(obs), self._split_obs(next_obs)
+        length = min(len(reward), self.max_episode_length)
+        pos = self.pos
+        for key in self._observation_keys:
+            self._buffer[key][pos, :length, 0] = obs[key][:length]
+        self._buffer["next_obs"][pos, :length, 0] = next_obs["observation"][:length]
+        self._buffer["next_achieved_goal"][pos, :length, 0] = next_obs["achieved_goal"][:length]
+        self._buffer["next_desired_goal"][pos, :length, 0] = next_obs["desired_goal"][:length]
+        self._buffer["action"][pos, :length] = action[:length]
+        self._buffer["reward"][pos, :length, 0] = reward[:length]
+        self._buffer["done"][pos, :length, 0] = done[:length]
+        self._buffer["gamma"][pos, :length, 0] = gamma[:length]
+        self.current_idx = length
+        self.store_episode()
+        self.episode_steps = 0
+
     def store_episode(self) -> None:
         """
         Increment episode counter
@@ -753,6 +1263,7 @@ class HerReplayBuffer(ReplayBuffer):
         """
         # add episode length to length storage
         self.episode_lengths[self.pos] = self.current_idx
+        self._num_added += self.current_idx
 
         # update current episode pointer
         # Note: in the OpenAI implementation
@@ -772,21 +1283,30 @@ class HerReplayBuffer(ReplayBuffer):
         """
 
         # Sample goals to create virtual transitions for the last episode.
-        observations, next_observations, actions, rewards = self._sample_offline(n_sampled_goal=self.n_sampled_goal)
+        transitions = self._sample_offline(n_sampled_goal=self.n_sampled_goal)
 
         # Store virtual transitions in the replay buffer, if available
-        if len(observations) > 0:
-            for i in range(len(observations["observation"])):
+        if len(transitions) > 0:
+            for i in range(len(transitions["reward"])):
                 self.replay_buffer.add(
-                    {key: obs[i] for key, obs in observations.items()},
-                    {key: next_obs[i] for key, next_obs in next_observations.items()},
-                    actions[i],
-                    rewards[i],
+                    {key: transitions[key][i, 0] for key in self._observation_keys},
+                    transitions["action"][i],
+                    transitions["reward"][i, 0],
+                    {
+                        "observation": transitions["next_obs"][i, 0],
+                        "achieved_goal": transitions["next_achieved_goal"][i, 0],
+                        "desired_goal": transitions["next_desired_goal"][i, 0],
+                    },
                     # We consider the transition as non-terminal
-                    done=[False],
-                    infos=[{}],
+                    False,
+                    transitions["gamma"][i, 0],
                 )
 
+    @property
+    def num_added(self):
+        """Total number of transitions stored since the buffer was created."""
+        return self._num_added
+
     @property
     def n_episodes_stored(self) -> int:
         if self.full:
@@ -840,19 +1360,131 @@ class HerReplayBuffer(ReplayBuffer):
             self.full = self.full or self.pos == 0
 
     def dump(self, save_dir):
-        fn = os.path.join(save_dir, "replay_buffer.pkl")
-        with open(fn, 'wb') as f:
-            pickle.dump(self._storage, f)
+        fn = os.path.join(save_dir, "replay_buffer")
+        # an episode still in progress is not part of the dump
+        columns = dict(storage_columns(self._buffer), episode_lengths=self.episode_lengths)
+        save_columns(fn, columns, {'pos': self.pos, 'full': self.full, 'max_episode_stored': self.max_episode_stored,
+                                   'max_episode_length': self.max_episode_length})
         print(f"Buffer dumped to {fn}")
 
+    def load(self, save_dir, mmap_mode='c'):
+        """Reopen a buffer written by `dump`, the episode storage stays memory mapped."""
+        columns, meta = load_columns(os.path.join(save_dir, "replay_buffer"), mmap_mode=mmap_mode)
+        assert meta['max_episode_stored'] == self.max_episode_stored and \
+            meta['max_episode_length'] == self.max_episode_length, "Saved buffer has a different capacity"
+        self.episode_lengths = np.array(columns.pop('episode_lengths'))
+        restore_storage(self._buffer, columns)
+        self.pos, self.full = meta['pos'], meta['full']
+        self.current_idx = 0
+        self.episode_steps = 0
+        return meta
+
+
+def stack_transitions(transitions):
+    """
+    Pack a list of (obs, action, reward, next_obs, done, gamma) transitions into one contiguous structured
+    array, one record per transition with flat float32 observations, that is sent as a single message.
+    """
+    obs, action, reward, next_obs, done, gamma = zip(*transitions)
+    obs = np.stack([flatten_obs(o) for o in obs])
+    action = np.stack([np.asarray(a).reshape(-1) for a in action])
+    batch = np.empty(len(transitions), dtype=[('obs', np.float32, obs.shape[1:]), ('action', np.float32, action.shape[1:]),
+                                              ('reward', np.float32), ('next_obs', np.float32, obs.shape[1:]),
+                                              ('done', np.float32), ('gamma', np.float32)])
+    batch['obs'], batch['action'], batch['reward'] = obs, action, reward
+    batch['next_obs'] = np.stack([flatten_obs(o) for o in next_obs])
+    batch['done'], batch['gamma'] = done, gamma
+    return batch
+
+
+def stack_batches(batches):
+    """Stack K sampled minibatches into one super-batch, every field gets a leading axis of size K."""
+    return [np.stack([flatten_obs(batch[field]) if field in (0, 3) else np.asarray(batch[field]) for batch in batches])
+            for field in range(len(batches[0]))]
+
+
+def split_super_batch(batch, batches_per_message):
+    """Minibatches of a message from the sampler, see `stack_batches`."""
+    if batches_per_message == 1:
+        return [batch]
+    return [[field[k] for field in batch] for k in range(batches_per_message)]
+
+
+class PriorityUpdateBatcher(object):
+    """Collects the priority updates of the learner steps run from one message and sends them together."""
+    def __init__(self, priority_queue):
+        self.priority_queue = priority_queue
+        self._inds, self._priorities = [], []
+
+    def put(self, item, *args, **kwargs):
+        inds, priorities = item
+        self._inds.append(np.asarray(inds).flatten())
+        self._priorities.append(np.asarray(priorities).flatten())
+
+    def flush(self):
+        if len(self._inds) == 0:
+            return
+        self.priority_queue.put((np.concatenate(self._inds), np.concatenate(self._priorities)))
+        self._inds, self._priorities = [], []
+
+
+def insert_replay(replay_buffer, replay):
+    """Insert a message sent by an agent: a single transition or a chunk of them (see `stack_transitions`)."""
+    if isinstance(replay, np.ndarray) and replay.dtype.names is not None:
+        replay_buffer.add_batch(replay)
+    else:
+        replay_buffer.add(*replay)
 
-def create_replay_buffer(config, save_dir):
+
+def replay_states(replay):
+    """Flat states of a message sent by an agent, (num_transitions, state_dim)."""
+    if isinstance(replay, np.ndarray) and replay.dtype.names is not None:
+        return replay['obs']
+    return np.atleast_2d(flatten_obs(replay[0]))
+
+
+def uses_her(config):
+    """Whether `create_replay_buffer` builds the HER buffer, prioritized or shared memory replay take precedence."""
+    return bool(config['her_memory']) and not config['replay_memory_prioritized'] and not config['replay_memory_shared']
+
+
+def agent_n_step(config):
+    """Horizon of the N-step transitions the agents send.
+    The buffer works from 1-step transitions when it computes the returns at sample time, and HER needs
+    them too: a relabeled reward is a single step reward and must not be bootstrapped with gamma ** N.
+    """
+    return 1 if config['replay_sample_n_step'] or uses_her(config) else config['n_step_return']
+
+
+def create_replay_buffer(config, save_dir, shared_storage=None):
     size = config['replay_mem_size']
+    # Transitions written by the agents into shared memory always use the ring buffer layout
+    ring = config['replay_memory_ring'] or shared_storage is not None
+    storage_dtypes = {'obs_dtype': config['replay_obs_dtype'], 'action_dtype': config['replay_action_dtype']}
+    # N-step returns computed when sampling need the stored 1-step transitions in episode order
+    assert not (config['replay_sample_n_step'] and (shared_storage is not None or config['her_memory'])), \
+        "Sample time N-step returns are not available with shared storage or HER"
+    dedup = (config['replay_memory_dedup'] or config['replay_sample_n_step']) and shared_storage is None
+    n_step = agent_n_step(config)
     if config['replay_memory_prioritized']:
         alpha = config['priority_alpha']
+        if dedup:
+            return PrioritizedEpisodeReplayBuffer(size, config['state_dim'], config['action_dim'], alpha=alpha,
+                                                  n_step=n_step, **storage_dtypes)
+        if ring:
+            return PrioritizedArrayReplayBuffer(size, config['state_dim'], config['action_dim'], alpha=alpha,
+                                                shared_storage=shared_storage, **storage_dtypes)
         return PrioritizedReplayBuffer(size=size, alpha=alpha, save_dir=save_dir)
-    elif config['her_memory']:
-        return HerReplayBuffer(config=config, buffer_size=size, save_dir=save_dir)
+    elif config['her_memory'] and shared_storage is None:
+        assert n_step == 1, "HER relabels 1-step transitions, the agents must not send N-step ones"
+        return HerReplayBuffer(config=config, buffer_size=size, save_dir=save_dir, online_sampling=True,
+                               n_sampled_goal=config['her_n_sampled_goal'],
+                               goal_selection_strategy=config['her_goal_selection_strategy'])
+    elif dedup:
+        return EpisodeReplayBuffer(size, config['state_dim'], config['action_dim'], n_step=n_step, **storage_dtypes)
+    elif ring:
+        return ArrayReplayBuffer(size, config['state_dim'], config['action_dim'], shared_storage=shared_storage,
+                                 **storage_dtypes)
     return ReplayBuffer(size)
 
 
@@ -879,14 +1511,100 @@ def quantile_regression_loss(input, target, tau, weight):
     return rho.sum(dim=-1)
 
 
+class TargetUpdater(object):
+    """Keeps the target networks of a learner in step with their online networks.
+    The parameters of all the (source, target) pairs are gathered once and every update is a single
+    in place multi-tensor (_foreach) call over all of them, without temporaries.
+    """
+    def __init__(self, *pairs):
+        """
+        :param pairs: (source, target) network pairs with the same parameter layout
+        """
+        self._sources, self._targets = [], []
+        for source, target in pairs:
+            self._sources += [param.data for param in source.parameters()]
+            self._targets += [param.data for param in target.parameters()]
+        assert len(self._sources) == len(self._targets), "Source and target networks differ"
+
+    @torch.no_grad()
+    def soft_update(self, tau):
+        """Polyak averaging, target <- (1 - tau) * target + tau * source."""
+        if hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(self._targets, self._sources, tau)
+        else:
+            torch._foreach_mul_(self._targets, 1.0 - tau)
+            torch._foreach_add_(self._targets, self._sources, alpha=tau)
+
+    @torch.no_grad()
+    def hard_update(self):
+        """Copy the sources into the targets."""
+        for target, source in zip(self._targets, self._sources):
+            target.copy_(source)
+
+
+class MixedPrecision(object):
+    """Reduced precision for the network forward / backward passes of a learner.
+    Only the network calls run under bfloat16 autocast, the parameters, the optimizer states and
+    whatever the caller computes outside `autocast()` (losses, projections) stay float32. The first
+    time an update produces non-finite losses or gradients, that step and every later step of the same
+    update are skipped and the learner falls back to float32 for good. `skipped_updates` counts the
+    dropped updates for the learner logs.
+    """
+    def __init__(self, precision, device):
+        """
+        :param precision: float32 (autocast disabled) or bfloat16
+        """
+        assert precision in ('float32', 'bfloat16'), f"Unsupported learner precision {precision}"
+        self.enabled = precision == 'bfloat16'
+        self.device_type = torch.device(device).type
+        self._skip_update = False
+        self.skipped_updates = 0
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=torch.bfloat16, enabled=self.enabled)
+
+    def begin_update(self):
+        """Call at the start of every learner update, before its first `step`."""
+        self._skip_update = False
+
+    def _skip(self):
+        self.enabled = False
+        self._skip_update = True
+        self.skipped_updates += 1
+
+    def check_finite(self, *tensors):
+        """Whether the update goes on: False once it was skipped, or when `tensors` (per sample losses)
+        are non-finite, in which case it is skipped from here on. Checked with or without autocast, the
+        losses become replay priorities.
+        """
+        if not self._skip_update:
+            if not all(torch.isfinite(tensor).all() for tensor in tensors):
+                self._skip()
+        return not self._skip_update
+
+    def step(self, optimizer, parameters):
+        """`optimizer.step()`, guarded against non-finite gradients while autocast is enabled.
+        Once a step of the update was skipped the following ones are too, their gradients come from the
+        same bfloat16 passes even though autocast is now disabled.
+        :return: False when the step was skipped
+        """
+        if self.enabled and not self._skip_update:
+            # an infinite max norm only measures the total norm, non-finite as soon as one gradient is
+            if not torch.isfinite(torch.nn.utils.clip_grad_norm_(parameters, float('inf'))):
+                self._skip()
+        if self._skip_update:
+            optimizer.zero_grad()
+            return False
+        optimizer.step()
+        return True
+
+
 def soft_update_from_to(source, target, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+    TargetUpdater((source, target)).soft_update(tau)
 
 
 def copy_model_params_from_to(source, target):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(param.data)
+    TargetUpdater((source, target)).hard_update()
 
 
 def fanin_init(tensor):